@@ -10,8 +10,15 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
-import file_utils as fu
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import utils as u
+import query as q
+import bgzf
+from transcripts import get_transcript
+from interval_index import open_index, bin_condition, MemoizedLookup, \
+    ChromIntervals, BIN_COL, table_columns, row_order, order_clause
+from dbsnp_filter import DbSnpFilter
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -93,426 +100,703 @@ def getFormatSpecificIndices(format='vcf'):
     return [chr_ind, pos_ind, ref_ind, alt_ind]
 
 
+COMPLEMENTS = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G'}
+
 def getComplementary(nuc):
-    compNuc = ''
-    if (str(nuc) == 'A'):
-        return 'T'
-    elif (str(nuc) == 'T'):
-        return 'A'
-    elif (str(nuc) == 'G'):
-        return 'C'
-    elif (str(nuc) == 'C'):
-        return 'G'
-    else:
-        return compNuc
+    return COMPLEMENTS.get(str(nuc), '')
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+"""Counters reported by the annotation stages
+   Each stage adds its counters together with the function that renders
+   them, so the .count.log can be written once after every stage finished
+"""
+class CountLog(object):
 
-    inds = getFormatSpecificIndices(format=format)
+    def __init__(self):
+        self.entries = []
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def add(self, render, label, **counts):
+        self.entries.append((render, label, counts))
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
-            rsids = []
-            mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
+    def render(self):
+        return ''.join([render(label, **counts)
+            for render, label, counts in self.entries])
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+    """Adds the counters of other, a log of the same stages run over
+       another part of the input
+    """
+    def merge(self, other):
+        if (len(self.entries) == 0):
+            self.entries = [(render, label, dict(counts))
+                for render, label, counts in other.entries]
+            return
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+        for i, (render, label, counts) in enumerate(other.entries):
+            total = self.entries[i][2]
+            for key, value in counts.items():
+                total[key] = total[key] + value
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+    def write(self, fh_log):
+        fh_log.write(self.render())
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
 
-            linenum = linenum + 1
+def renderDbSnpCounts(label, variants, found):
+    total = variants + 1
+    ratioInDbSnp = (found / float(total)) * 100
+    return "## Please notice that all Isoforms were counted\n" + \
+        "## Numbers may exceed number of variants in the annotated file\n" + \
+        f"Total: {str(total)}\n" + \
+        f"In dbSNP: {str(found)} ({str(ratioInDbSnp)}%)\n"
 
-        else:
-            fh_out.write(line + '\n')
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+def renderLocationCounts(label, interGenic, cds, utr3, utr5, intronic,
+    non_coding_intronic, exonic, non_coding_exonic, promoter):
+    return "Variants located:\n" + \
+        f"In interGenic {str(interGenic)}\n" + \
+        f"In CDS {str(cds)}\n" + \
+        f"In \'3 UTR {str(utr3)}\n" + \
+        f"In \'5 UTR {str(utr5)}\n" + \
+        f"In Intronic {str(intronic)}\n" + \
+        f"In Non_coding_intronic {str(non_coding_intronic)}\n" + \
+        f"In Exonic {str(exonic)}\n" + \
+        f"In Non_coding_exonic {str(non_coding_exonic)}\n" + \
+        f"In Putative Promoter Region {str(promoter)}\n"
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
+def renderOverlapCounts(label, var_count, line_count):
+    return f"In {str(label)}: {str(var_count)} in " + \
+        f"{str(line_count)} variants\n"
 
-"""NOTE: all isoforms are collapsed in one record
-    1. chrom_pos_equal_base
-    2. chrom_pos_equal_nobase
-    3. chrom_pos_unequal
-"""
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
+def renderDbSnpFilterCounts(label, lookups, screened, positions, queries):
+    ratio = (screened / float(lookups)) * 100 if (lookups > 0) else 0.0
+    return f"dbSNP filter {str(label)}: {str(screened)} of {str(lookups)} " + \
+        f"lookups screened out ({str(ratio)}%), {str(positions)} " + \
+        "positions left out of the IN lists, " + \
+        f"{str(queries)} chromosome queries skipped\n"
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+def renderCacheCounts(label, hits, lookups):
+    ratio = (hits / float(lookups)) * 100 if (lookups > 0) else 0.0
+    return f"Cached {str(label)}: {str(hits)} of {str(lookups)} " + \
+        f"lookups ({str(ratio)}%)\n"
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
 
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
+def renderStrategyChoice(label, strategy, records, rows, **costs):
+    return f"Lookup strategy {str(label)}: {strategy} for {str(records)} " + \
+        f"variants over {str(rows)} rows (estimated cost " + \
+        ', '.join([f"{s} {str(c)}" for s, c in costs.items()]) + ")\n"
 
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
 
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
+# Position of INFO in a record
+INFO_FIELD = 7
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+"""INFO column of a record under annotation
+   Stages add their entries to it rather than rebuilding the string with
+   every one; the pieces are joined once, when the record is written or a
+   stage reads the whole value with str(). The text is the same the
+   concatenations gave.
+"""
+class InfoBuilder(object):
+    __slots__ = ['parts']
+
+    def __init__(self, value):
+        self.parts = [value]
+
+    def __str__(self):
+        if (len(self.parts) > 1):
+            self.parts = [''.join(self.parts)]
+        return self.parts[0]
+
+    def endswith(self, suffix):
+        text = ''
+        for part in reversed(self.parts):
+            text = part + text
+            if (len(text) >= len(suffix)):
+                break
+        return text.endswith(suffix)
+
+    """Adds entry after a ';'
+    """
+    def append(self, entry):
+        self.parts.append(';' + entry)
+
+    """Adds entry after a ';', unless the value already ends with one
+    """
+    def extend(self, entry):
+        if not self.endswith(';'):
+            self.parts.append(';')
+        self.parts.append(entry)
+
+    def prepend(self, text):
+        self.parts.insert(0, text)
+
+    def set(self, value):
+        self.parts = [value]
+
+    def dropPrefix(self, prefix):
+        value = str(self)
+        if value.startswith(prefix):
+            self.parts = [value[len(prefix):]]
+
+
+"""The InfoBuilder of a record, set in place of its INFO text on first use
+"""
+def recordInfo(fields):
+    info = fields[INFO_FIELD]
+    if isinstance(info, str):
+        info = InfoBuilder(info)
+        fields[INFO_FIELD] = info
+    return info
 
-            if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
 
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
+"""Adds the hit counters of cache (a result_cache.ResultCache), if any
+"""
+def addCacheCounts(log, cache, stage):
+    if (cache is not None):
+        log.add(renderCacheCounts, stage, **cache.counts(stage))
 
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
 
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+# Fields a record is split into: CHROM to INFO, then FORMAT and the sample
+# columns, which no stage reads, carried through as one tab-joined string
+RECORD_FIELDS = 8
+# Buffer of the record files, large enough for the lines of wide VCFs
+IO_BUFFER_SIZE = 1 << 20
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+"""Reads VCF (or pileup) lines
+   Header lines are yielded as stripped strings, records as lists of at
+   most RECORD_FIELDS + 1 fields
+"""
+def readRecords(fh, sep='\t'):
+    for line in fh:
+        line = line.strip()
+        if (line.startswith('#') or line.startswith('CHROM')):
+            yield line
+        else:
+            fields = line.split(sep, RECORD_FIELDS)
+            if (sep != '\t' and len(fields) > RECORD_FIELDS):
+                fields[RECORD_FIELDS] = fields[RECORD_FIELDS].replace(sep,
+                    '\t')
+            yield fields
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+def isHeader(record):
+    return isinstance(record, str)
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+"""Writes header lines and records produced by readRecords or a stage
+"""
+def writeRecords(records, fh_out):
+    for record in records:
+        if isHeader(record):
+            fh_out.write(record + '\n')
+        else:
+            if (len(record) > INFO_FIELD and
+                not isinstance(record[INFO_FIELD], str)):
+                record[INFO_FIELD] = str(record[INFO_FIELD])
+            fh_out.write('\t'.join(record) + '\n')
 
-            if (keep_going):
-                fh_out.write(line + '\n')
 
-            vcf_linenum = vcf_linenum + 1
+LOOKUP_CHUNK_SIZE = 1000
 
-        else:
-            fh_out.write(line + '\n')
+"""Maps a record to its (chrom, pos) lookup
+   The reference tables name chromosomes 'chr1', 'chrX', ...; with
+   prefix=False the 'chr' is stripped instead, as gadAll expects
+"""
+def lookupKey(fields, inds, prefix=True):
+    chr = fields[inds[0]].strip()
+    if prefix and not chr.startswith("chr"):
+        chr = "chr" + chr
+    elif not prefix and chr.startswith("chr"):
+        chr = str(chr).replace("chr", "")
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return (chr, fields[inds[1]].strip())
 
 
-"""Get information about location in gene structures
+"""Pairs every record with the rows of index it overlaps
+   key maps a record to a (chrom, pos) lookup, or to None to skip it;
+   headers and skipped records are paired with None. Records are resolved
+   chunk_size at a time through index.overlaps_many (first_many when first
+   is set), so a strategy can answer a whole chunk at once.
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+def lookupRecords(records, index, key, first=False,
+    chunk_size=LOOKUP_CHUNK_SIZE):
+
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if (len(chunk) >= chunk_size):
+            yield from lookupChunk(chunk, index, key, first)
+            chunk = []
+    yield from lookupChunk(chunk, index, key, first)
+
+
+def lookupChunk(chunk, index, key, first=False):
+    keys = [None if isHeader(record) else key(record) for record in chunk]
+    lookups = [k for k in keys if k is not None]
+    if first:
+        results = iter(index.first_many(lookups))
+    else:
+        results = iter(index.overlaps_many(lookups))
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+    for record, k in zip(chunk, keys):
+        yield record, (None if (k is None) else next(results))
 
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+"""Groups records into batches of batch_size variants
+   Yields (pending, batch) pairs: pending holds the header lines and
+   records since the previous batch in input order, batch the variant(fields)
+   of each record. The last batch may be short, or empty.
+"""
+def batchRecords(records, variant, batch_size):
+    pending = []
+    batch = []
+
+    for fields in records:
+        if not isHeader(fields):
+            batch.append(variant(fields))
+        pending.append(fields)
+
+        if (len(batch) >= batch_size):
+            yield pending, batch
+            pending = []
+            batch = []
+
+    yield pending, batch
+
+
+"""Resolves the batches of batchRecords with fetch(cursor, batch)
+   Yields (pending, batch, result) in the order of batches. With
+   concurrency > 1, up to concurrency batches are fetched at once, each
+   on a connection of its own taken from pool (a utils.ConnectionPool, the
+   run's; one of concurrency connections is opened if none is given);
+   finished batches wait in a reorder buffer until every batch before them
+   is out.
+"""
+def fetchInOrder(batches, fetch, cursor, concurrency=1, pool=None):
+    if (concurrency <= 1):
+        for pending, batch in batches:
+            yield pending, batch, fetch(cursor, batch)
+        return
+
+    own_pool = (pool is None)
+    if own_pool:
+        pool = u.ConnectionPool(size=concurrency)
+
+    def task(batch):
+        conn = pool.acquire()
+        try:
+            return fetch(conn.cursor(), batch)
+        finally:
+            pool.release(conn)
+
+    inflight = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for pending, batch in batches:
+                inflight.append((pending, batch,
+                    executor.submit(task, batch)))
+                if (len(inflight) >= concurrency):
+                    pending, batch, future = inflight.popleft()
+                    yield pending, batch, future.result()
+            while (len(inflight) > 0):
+                pending, batch, future = inflight.popleft()
+                yield pending, batch, future.result()
+    finally:
+        if own_pool:
+            pool.close()
+
+
+"""kwargs of a stage with pool (a utils.ConnectionPool) for the
+   connections of the queries it keeps in flight, if it keeps any
+"""
+def stageKwargs(kwargs, pool):
+    if ('concurrency' in kwargs):
+        return dict(kwargs, pool=pool)
+    return kwargs
+
+
+"""Runs one annotation stage from a temporary file to the next one
+   stage is one of the iter* generators below; its counters are written to
+   the .count.log, which is truncated first when logmode is 'w'
+   The connection is taken from pool (a utils.ConnectionPool) if given,
+   and so are those of the queries the stage keeps in flight
+   A .gz or .bgz input is decompressed as it is read; the output is
+   written as BGZF if compress
+"""
+def runStage(stage, vcf, tmpextin='', tmpextout='.1', logmode='a',
+    sep='\t', pool=None, compress=False, **kwargs):
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
+    if (pool is None):
+        # Nothing to share the connection with, close it when done
+        pool = u.ConnectionPool(size=0)
 
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+    fh = bgzf.open_input(vcf + tmpextin, buffering=IO_BUFFER_SIZE)
+    fh_out = bgzf.open_output(vcf + tmpextout, compress,
+        buffering=IO_BUFFER_SIZE)
+    conn = pool.acquire()
+    log = CountLog()
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
+    writeRecords(stage(readRecords(fh, sep), conn.cursor(), log,
+        **stageKwargs(kwargs, pool)), fh_out)
 
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
+    if (len(log.entries) > 0):
+        fh_log = open(vcf + '.count.log', logmode)
+        log.write(fh_log)
+        fh_log.close()
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
+    pool.release(conn)
+    fh.close()
+    fh_out.close()
 
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
 
-                    else:
-                        region = ''
+"""Resolves a batch of variants against dbSNP
+   variants is a list of (chr, pos, ref, compRef) tuples. One query is
+   issued per chromosome in the batch and the rows are demultiplexed back,
+   so the result holds, for every variant, the rows the per-variant query
+   select * from dbSNP where CHR=chr AND POS=pos AND
+       (REF=ref OR REF=compRef) AND INFO=varclass
+   would have returned, in the same order.
+"""
+def queryDbSnpBatch(cursor, variants, varclass='SNV'):
+    by_chr = {}
+    for i, (chr, pos, ref, compRef) in enumerate(variants):
+        by_chr.setdefault(chr, []).append(i)
+
+    found = [[] for v in variants]
+    for chr, members in by_chr.items():
+        positions = set([int(variants[i][1]) for i in members])
+        refs = set([])
+        for i in members:
+            refs.add(variants[i][2])
+            refs.add(variants[i][3])
+
+        pos_list, pos_params = q.in_list(sorted(positions))
+        ref_list, ref_params = q.in_list(sorted(refs))
+        q.execute(cursor, 'select * from dbSNP where CHR = ? AND POS IN ' +
+            pos_list + ' AND REF IN ' + ref_list + ' AND INFO = ?;',
+            [str(chr)] + pos_params + ref_params + [varclass])
+        names = [d[0] for d in cursor.description]
+        pos_ind = names.index('POS')
+        ref_ind = names.index('REF')
+
+        rows_at = {}
+        for row in cursor.fetchall():
+            rows_at.setdefault(int(row[pos_ind]), []).append(row)
+
+        for i in members:
+            chr, pos, ref, compRef = variants[i]
+            # The REF comparison follows MySQL's case-insensitive collation
+            wanted = (ref.upper(), compRef.upper())
+            for row in rows_at.get(int(pos), []):
+                if (str(row[ref_ind]).upper() in wanted):
+                    found[i].append(row)
+
+    return found
+
+
+"""queryDbSnpBatch answered from cache (a result_cache.ResultCache) first
+"""
+def queryDbSnpCached(cursor, variants, varclass='SNV', cache=None):
+    if (cache is None):
+        return queryDbSnpBatch(cursor, variants, varclass)
+
+    return cache.resolve('dbSNP.' + varclass,
+        [(chr, pos, ref, '') for chr, pos, ref, compRef in variants],
+        lambda missing: queryDbSnpBatch(cursor,
+            [variants[i] for i in missing], varclass))
+
+
+"""queryDbSnpCached for the variants dbsnp_filter (a
+   dbsnp_filter.DbSnpFilter) may find in dbSNP; the others get no rows
+   Returns the rows of every variant, the number of variants screened out,
+   the number of positions left out of the IN lists of queryDbSnpBatch,
+   and the number of per-chromosome queries not needed at all: a
+   chromosome is only skipped when every one of its variants is screened
+   out, so the saving is mostly in the size of the IN lists
+"""
+def queryDbSnpScreened(cursor, variants, varclass='SNV', cache=None,
+    dbsnp_filter=None):
+    if (dbsnp_filter is None):
+        return queryDbSnpCached(cursor, variants, varclass, cache), 0, 0, 0
+
+    passed = [i for i, variant in enumerate(variants)
+        if dbsnp_filter.might_contain(variant[0], variant[1])]
+    found = [[] for v in variants]
+    if (len(passed) > 0):
+        rows = queryDbSnpCached(cursor, [variants[i] for i in passed],
+            varclass, cache)
+        for i, variant_rows in zip(passed, rows):
+            found[i] = variant_rows
+
+    # The filter is keyed by position, a screened position never passes
+    passed_set = set(passed)
+    positions = len(set([(v[0], int(v[1])) for i, v in enumerate(variants)
+        if i not in passed_set]))
+    queries = len(set([v[0] for v in variants])) - \
+        len(set([variants[i][0] for i in passed]))
+    return found, len(variants) - len(passed), positions, queries
+
+
+"""Annotates a batch of records with their dbSNP rows
+   pending holds header lines and records in input order, batch_rows the
+   dbSNP rows of each record; returns the number of records in dbSNP
+"""
+def annotateDbSnpBatch(pending, batch_rows, varclass='SNV'):
+    var_count = 0
+    batch_rows = iter(batch_rows)
+
+    for fields in pending:
+        if isHeader(fields):
+            continue
+
+        rows = next(batch_rows)
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = '.'
+        rsids = []
+        mafs = []
+        if (len(rows) > 0):
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
+
+            var_count = var_count + 1
+            info = recordInfo(fields)
+            if (str(info) == '.'):
+                info.set('DB' + maf_str)
+            else:
+                info.append('DB;VC=' + varclass + maf_str)
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
+            fields[2] = str(';'.join(rsids))
 
-                    cnt = cnt + 1
+    return var_count
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    Records are looked up in batches of batch_size variants, concurrency
+    batches at a time (see fetchInOrder)
+    dbsnp_filter is the file written by dbsnp_filter.py; variants it
+    screens out are not queried
+"""
+def iterSnpsFromDbSnp(records, cursor, log, format='vcf', varclass='SNV',
+    batch_size=5000, cache=None, concurrency=1, dbsnp_filter=None,
+    pool=None):
+
+    screen = DbSnpFilter(dbsnp_filter) if dbsnp_filter else None
+    screened = 0
+    positions = 0
+    queries = 0
+    var_count = 0
+    inds = getFormatSpecificIndices(format=format)
+    linenum = 1
 
-            linenum = linenum + 1
+    def variant(fields):
+        chr = fields[inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
+
+        pos = fields[inds[1]].strip()
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        compRef = getComplementary(ref)
+        return (chr, pos, ref, compRef)
+
+    fetch = lambda cursor, batch: queryDbSnpScreened(cursor, batch,
+        varclass, cache, screen)
+
+    for pending, batch, (batch_rows, batch_screened, batch_positions,
+        batch_queries) in fetchInOrder(batchRecords(records, variant,
+        batch_size), fetch, cursor, concurrency, pool):
+        screened = screened + batch_screened
+        positions = positions + batch_positions
+        queries = queries + batch_queries
+        linenum = linenum + len(batch)
+        var_count = var_count + annotateDbSnpBatch(pending, batch_rows,
+            varclass)
+        yield from pending
+
+    log.add(renderDbSnpCounts, 'dbSNP', variants=linenum - 1,
+        found=var_count)
+    if (screen is not None):
+        log.add(renderDbSnpFilterCounts, screen.header['build'],
+            lookups=linenum - 1, screened=screened, positions=positions,
+            queries=queries)
+        screen.close()
+    addCacheCounts(log, cache, 'dbSNP.' + varclass)
 
-        else:
-            fh_out.write(line + '\n')
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=5000):
+    # Always reads the original file and starts a new .count.log
+    runStage(iterSnpsFromDbSnp, vcf, '', tmpextout, logmode='w', sep=sep,
+        format=format, varclass=varclass, batch_size=batch_size)
+
+
+"""Resolves a batch of variants against the BigRefGene tables
+   variants is a list of (chr, pos, ref, alt, compRef, compAlt) tuples.
+   The tables are tried in order and a variant takes the rows of the first
+   one with a match, as the per-variant queries
+       select * from chrom_pos_equal_base where CHR=chr AND start=pos AND
+           ((haplotypeReference=ref AND haplotypeAlternate=alt) OR
+           (haplotypeReference=compRef AND haplotypeAlternate=compAlt))
+       select * from chrom_pos_equal_nobase where CHR=chr AND start=pos
+       select * from chrom_pos_unequal where CHR=chr AND
+           start <= pos AND pos <= end
+   would; each table is queried once per chromosome for the variants
+   still unmatched.
+"""
+def queryBigRefGeneBatch(cursor, variants):
+    found = [[] for v in variants]
+    by_chr = {}
+    for i, variant in enumerate(variants):
+        by_chr.setdefault(variant[0], []).append(i)
+
+    for chr, members in by_chr.items():
+        where = 'where CHR = ? AND '
+        positions = sorted(set([int(variants[i][1]) for i in members]))
+
+        # 1. chrom_pos_equal_base
+        haplotypes = set([])
+        for i in members:
+            chr, pos, ref, alt, compRef, compAlt = variants[i]
+            haplotypes.add((ref, alt))
+            haplotypes.add((compRef, compAlt))
+        pos_list, params = q.in_list(positions)
+        haplotypes = q.in_list(sorted(haplotypes))[1]
+        sql = 'select * from chrom_pos_equal_base ' + where + 'start IN ' + \
+            pos_list + ' AND (' + ' OR '.join(['(haplotypeReference = ? ' +
+            'AND haplotypeAlternate = ?)'] * len(haplotypes)) + ');'
+        for r, a in haplotypes:
+            params = params + [r, a]
+        rows_at, cols = fetchRowsByColumn(cursor, sql, [str(chr)] + params,
+            'start')
+        ref_ind = cols.index('haplotypereference')
+        alt_ind = cols.index('haplotypealternate')
+        for i in members:
+            chr, pos, ref, alt, compRef, compAlt = variants[i]
+            # Comparisons follow MySQL's case-insensitive collation
+            wanted = ((ref.upper(), alt.upper()),
+                (compRef.upper(), compAlt.upper()))
+            found[i] = [row for row in rows_at.get(int(pos), [])
+                if ((str(row[ref_ind]).upper(),
+                    str(row[alt_ind]).upper()) in wanted)]
+
+        # 2. chrom_pos_equal_nobase
+        members = [i for i in members if (len(found[i]) == 0)]
+        if (len(members) == 0):
+            continue
+        positions = sorted(set([int(variants[i][1]) for i in members]))
+        pos_list, params = q.in_list(positions)
+        sql = 'select * from chrom_pos_equal_nobase ' + where + 'start IN ' + \
+            pos_list + ';'
+        rows_at, cols = fetchRowsByColumn(cursor, sql, [str(chr)] + params,
+            'start')
+        for i in members:
+            found[i] = rows_at.get(int(variants[i][1]), [])
+
+        # 3. chrom_pos_unequal: one range query over the window of the
+        # positions, which the (CHR, start) index can serve, and the rows
+        # are assigned to positions through an interval tree
+        members = [i for i in members if (len(found[i]) == 0)]
+        if (len(members) == 0):
+            continue
+        positions = [int(variants[i][1]) for i in members]
+        sql = 'select * from chrom_pos_unequal ' + where + \
+            'start <= ? AND end >= ?;'
+        q.execute(cursor, sql, [str(chr), max(positions), min(positions)])
+        cols = [d[0].lower() for d in cursor.description]
+        start_ind = cols.index('start')
+        end_ind = cols.index('end')
+        intervals = ChromIntervals([(int(row[start_ind]), int(row[end_ind]),
+            row) for row in cursor.fetchall()])
+        for i, pos in zip(members, positions):
+            found[i] = intervals.overlaps(pos, pos)
+
+    return found
+
+
+"""Runs sql with params and groups the rows by the integer value of column
+   Returns the groups and the lower-cased column names
+"""
+def fetchRowsByColumn(cursor, sql, params, column):
+    q.execute(cursor, sql, params)
+    cols = [d[0].lower() for d in cursor.description]
+    ind = cols.index(column)
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+    rows_at = {}
+    for row in cursor.fetchall():
+        rows_at.setdefault(int(row[ind]), []).append(row)
+    return rows_at, cols
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+"""Annotates a batch of records with their BigRefGene rows
+"""
+def annotateBigRefGeneBatch(pending, batch_rows):
+    batch_rows = iter(batch_rows)
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+    for fields in pending:
+        if isHeader(fields):
+            continue
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+        rows = next(batch_rows)
+        if (len(rows) > 0):
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+            info = recordInfo(fields)
+            info.append(';'.join(m))
+            info.dropPrefix('.;')
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+"""NOTE: all isoforms are collapsed in one record
+    1. chrom_pos_equal_base
+    2. chrom_pos_equal_nobase
+    3. chrom_pos_unequal
+    Records are looked up in batches of batch_size variants, concurrency
+    batches at a time (see fetchInOrder)
+"""
+def iterBigRefGene(records, cursor, log, format='vcf', batch_size=1000,
+    concurrency=1, pool=None):
+    inds = getFormatSpecificIndices(format=format)
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    def variant(fields):
+        chr = fields[inds[0]].strip()
+        if chr.startswith("chr"):
+            chr = chr.replace('chr', '')
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+        pos = fields[inds[1]].strip()
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        alt = clean_mysql_chars(fields[inds[3]]).strip()
 
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+        return (chr, pos, ref, alt, compRef, compAlt)
+
+    for pending, batch, batch_rows in fetchInOrder(
+        batchRecords(records, variant, batch_size), queryBigRefGeneBatch,
+        cursor, concurrency, pool):
+        annotateBigRefGeneBatch(pending, batch_rows)
+        yield from pending
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    batch_size=1000):
+    runStage(iterBigRefGene, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, batch_size=batch_size)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+
+"""Get information about location in gene structures
+"""
+def iterGenes(records, cursor, log, format='vcf', table='refGene',
+    promoter_offset=500, strategy='point', cpg_strategy='index',
+    snapshot_dir=None):
 
     interGenic_count = 0
     cds_count = 0
@@ -525,603 +809,568 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     promoter_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
     linenum = 1
+    # Transcripts within promoter_offset of a position
+    genes = open_index(cursor, table, strategy, start_col='txStart',
+        end_col='txEnd', snapshot_dir=snapshot_dir)
+    # CpG islands of the putative promoter regions, memoized per position
+    cpgIslands = MemoizedLookup(open_index(cursor, 'cpgIslandExt',
+        cpg_strategy, columns='chrom, chromStart, chromEnd, name',
+        snapshot_dir=snapshot_dir))
+
+    for fields in records:
+        if isHeader(fields):
+            yield fields
+            continue
+
+        chr = fields[inds[0]].strip()
+
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        alt = clean_mysql_chars(fields[inds[3]]).strip()
+        info_field = clean_mysql_chars(str(fields[7])).strip()
+        info_pairs = u.parse_fields(info_field, ';', '=')
+        this_gene_name = str(u.find_field(info_pairs, 'name'))
+
+        # (txStart - promoter_offset) <= pos <= (txEnd + promoter_offset)
+        rows = genes.overlaps(chr, int(pos) - int(promoter_offset),
+            int(pos) + int(promoter_offset))
+        info = []
+
+        if (len(rows) > 0):
+            cnt = 1
+            positionType = str(u.find_field(info_pairs, 'positionType'))
+            for row in rows:
+                #count location
+                if (positionType == 'intron'):
+                    intronic_count = intronic_count + 1
+                elif (positionType == 'non_coding_intron'):
+                    non_coding_intronic_count = non_coding_intronic_count + 1
+                elif (positionType == 'CDS'):
+                    cds_count = cds_count + 1
+                elif (positionType == 'non_coding_exon'):
+                    non_coding_exonic_count = non_coding_exonic_count + 1
+                elif (positionType == 'utr5'):
+                    utr5_count = utr5_count + 1
+                elif (positionType == 'utr3'):
+                    utr3_count = utr3_count + 1
+
+                transcript = get_transcript(row)
+                txtStart = transcript.txStart
+                txtEnd = transcript.txEnd
+                cdsStart = transcript.cdsStart
+                cdsEnd = transcript.cdsEnd
+                exonCount = transcript.exonCount
+                geneSymbol = str(row[12])
+                strand = transcript.strand
+
+                promoter_plus = txtStart - int(promoter_offset)
+                promoter_minus = txtEnd + int(promoter_offset)
+                region = ""
+                pos = int(pos)
+                exons = []
+
+                if (cdsStart == cdsEnd):
+                    for exnum in transcript.exon_numbers(pos):
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+                elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                    for exnum in transcript.exon_numbers(pos):
+                        exons.append("exon=" +  "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        exonic_count = exonic_count + 1
+                    if (len(exons) > 0):
+                        region = ";".join(exons)
+
+                elif (u.isBetween(pos, promoter_plus, txtStart) and
+                    (strand == "+")):
+                    cpg = cpgIslands.first(chr, pos)
+
+                    if (cpg is not None):
+                        region = 'putativePromoterRegion=' + \
+                            "".join(str(cpg[3]).split())
+                        promoter_count = promoter_count + 1
+
+                elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                    cpg = cpgIslands.first(chr, pos)
+                    if (cpg is not None):
+                        region = 'putativePromoterRegion=' +  \
+                            "".join(str(cpg[3]).split())
+                        promoter_count = promoter_count + 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
+                else:
+                    region = ''
 
-                    else:
-                        region = ''
+                if (region != ''):
+                    info.append(collapseGeneNames(row=row,
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
 
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
+                cnt = cnt + 1
 
-                    cnt = cnt + 1
+            str_info = ";".join(info)
+            recordInfo(fields).append(str_info)
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+        else:
+            recordInfo(fields).append("positionType=interGenic")
+            interGenic_count = interGenic_count + 1
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+        linenum = linenum + 1
+        yield fields
 
-            linenum = linenum + 1
+    counts = dict(interGenic=interGenic_count, cds=cds_count,
+        utr3=utr3_count, utr5=utr5_count, intronic=intronic_count,
+        non_coding_intronic=non_coding_intronic_count, exonic=exonic_count,
+        non_coding_exonic=non_coding_exonic_count, promoter=promoter_count)
+    print(renderLocationCounts(table, **counts), end='')
+    log.add(renderLocationCounts, table, **counts)
 
-        else:
-            fh_out.write(line + '\n')
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runStage(iterGenes, vcf, tmpextin, tmpextout, sep=sep, format=format,
+        table=table, promoter_offset=promoter_offset)
+
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+def iterExonsEtAl(records, cursor, log, format='vcf', table='refGene',
+    promoter_offset=500, strategy='point', cpg_strategy='index',
+    snapshot_dir=None):
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    interGenic_count = 0
+    cds_count = 0
+    utr3_count = 0
+    utr5_count = 0
+    intronic_count = 0
+    non_coding_intronic_count = 0
+    exonic_count = 0
+    non_coding_exonic_count = 0
+    promoter_count = 0
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+    inds = getFormatSpecificIndices(format=format)
+    linenum = 1
+    # Transcripts within promoter_offset of a position
+    genes = open_index(cursor, table, strategy, start_col='txStart',
+        end_col='txEnd', snapshot_dir=snapshot_dir)
+    # CpG islands of the putative promoter regions, memoized per position
+    cpgIslands = MemoizedLookup(open_index(cursor, 'cpgIslandExt',
+        cpg_strategy, columns='chrom, chromStart, chromEnd, name',
+        snapshot_dir=snapshot_dir))
+
+    for fields in records:
+        if isHeader(fields):
+            yield fields
+            continue
+
+        chr = fields[inds[0]].strip()
+
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+        ref = clean_mysql_chars(fields[inds[2]]).strip()
+        alt = clean_mysql_chars(fields[inds[3]]).strip()
+        info_field = clean_mysql_chars(str(fields[7])).strip()
+        this_gene_name = str(u.find_field(
+            u.parse_fields(info_field, ';', '='), 'name'))
+
+        # (txStart - promoter_offset) <= pos <= (txEnd + promoter_offset)
+        rows = genes.overlaps(chr, int(pos) - int(promoter_offset),
+            int(pos) + int(promoter_offset))
+        info = []
+        if (len(rows) > 0):
+            cnt = 1
+            for row in rows:
+                transcript = get_transcript(row)
+                txtStart = transcript.txStart
+                txtEnd = transcript.txEnd
+                cdsStart = transcript.cdsStart
+                cdsEnd = transcript.cdsEnd
+                exonCount = transcript.exonCount
+                geneSymbol = str(row[12])
+                strand = transcript.strand
+
+                promoter_plus = txtStart - int(promoter_offset)
+                promoter_minus = txtEnd + int(promoter_offset)
+                region = ""
+                pos = int(pos)
+                exons = []
+
+                if (cdsStart == cdsEnd):
+                    for exnum in transcript.exon_numbers(pos):
+                        exons.append("non_coding_exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        non_coding_exonic_count = non_coding_exonic_count + 1
+                    if (len(exons) > 0):
+                        region='positionType=non_coding_exon;' + ";".join(exons)
+                    else:
+                        non_coding_intronic_count = non_coding_intronic_count + 1
+                        region = 'positionType=non_coding_intron'
+
+                elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+                    cds_count = cds_count + 1
+                    for exnum in transcript.exon_numbers(pos):
+                        exons.append("exon=" + "ex" + \
+                            str(exnum) + '/' + str(exonCount))
+                        exonic_count=exonic_count+1
+                    if (len(exons) > 0):
+                        region = 'positionType=CDS;' + ";".join(exons)
+                    else:
+                        intronic_count = intronic_count + 1
+                        region = 'positionType=CDS;' + 'intron'
+
+                elif (u.isBetween(pos, txtStart, cdsStart) and \
+                    (cdsStart < cdsEnd) and (strand == "+")):
+                    utr5_count = utr5_count + 1
+                    region = 'positionType=utr5'
+
+                elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+                    (cdsStart < cdsEnd) (strand == "+")):
+                    utr3_count = utr3_count + 1
+                    region = 'positionType=utr3'
+
+                elif (u.isBetween(pos, cdsEnd, txtEnd) and
+                    (cdsStart < cdsEnd) (strand == "-")):
+                    utr5_count = utr5_count + 1
+                    region = 'positionType=utr5'
+
+                elif (u.isBetween(pos, txtStart, cdsStart) and \
+                    (cdsStart < cdsEnd) and (strand == "-")):
+                    utr3_count = utr3_count + 1
+                    region = 'positionType=utr3'
+
+                elif (u.isBetween(pos, promoter_plus, txtStart) and \
+                    (strand == "+")):
+                    cpg = cpgIslands.first(chr, pos)
+
+                    if (cpg is not None):
+                        region = 'putativePromoterRegion=' + \
+                            "".join(str(cpg[3]).split())
+                        promoter_count = promoter_count + 1
+
+                elif (u.isBetween(pos, txtEnd, promoter_minus) and \
+                    (strand == "-")):
+                    cpg = cpgIslands.first(chr, pos)
+
+                    if (cpg is not None):
+                        region = 'putativePromoterRegion=' + \
+                        "".join(str(cpg[3]).split())
+                        promoter_count = promoter_count + 1
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+                else:
+                    region = ''
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
+                if (region != ''):
+                    info.append(collapseGeneNames(
+                        row=row, indices=indicesKnownGenes,
+                        region=region, cnt=cnt))
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+                cnt = cnt + 1
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+            str_info = ";".join(info)
+            recordInfo(fields).append(str_info)
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        else:
+            recordInfo(fields).append("positionType=interGenic")
+            interGenic_count = interGenic_count + 1
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+        linenum = linenum + 1
+        yield fields
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    counts = dict(interGenic=interGenic_count, cds=cds_count,
+        utr3=utr3_count, utr5=utr5_count, intronic=intronic_count,
+        non_coding_intronic=non_coding_intronic_count, exonic=exonic_count,
+        non_coding_exonic=non_coding_exonic_count, promoter=promoter_count)
+    print(renderLocationCounts(table, **counts), end='')
+    log.add(renderLocationCounts, table, **counts)
+
+
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runStage(iterExonsEtAl, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table, promoter_offset=promoter_offset)
 
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+def iterOverlapWithTfbsConsSites(records, cursor, log, format='vcf',
+    table='tfbsConsSites', strategy='index', snapshot_dir=None, cache=None,
+    concurrency=1, pool=None):
 
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+    # One table per chromosome: tfbsConsSites1, ... tfbsConsSitesY
+    index = open_index(cursor, table, strategy, sharded=True,
+        columns='chrom, chromStart, chromEnd, name',
+        snapshot_dir=snapshot_dir, cache=cache,
+        concurrency=concurrency, pool=pool)
+
+    def key(fields):
+        chr, pos = lookupKey(fields, inds)
+        chrIndex = chr.replace('chr', '')
+        if (chrIndex in allowed_chrom):
+            return (chrIndex, pos)
+        return None
+
+    for fields, rows in lookupRecords(records, index, key):
+        if isHeader(fields):
+            yield fields
+            continue
+
+        if rows is not None:
+            found = []
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
+            if (len(rows) > 0):
+                records_count = 1
+                line_count = line_count + 1
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
+                for row in rows:
+                    var_count = var_count + 1
+                    t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                        str(row[1]) + '.' + str(row[2])
+                    t = t.strip()
+                    found.append('tfbsRegion' + '=' + t)
+                    records_count = records_count + 1
 
-                    fh_out.write('\t'.join(fields) + '\n')
+                recordInfo(fields).extend(';'.join(found))
 
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+        yield fields
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+    log.add(renderOverlapCounts, table, var_count=var_count,
+        line_count=line_count)
+    addCacheCounts(log, cache, table)
+    index.close()
 
-        linenum = linenum + 1
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
+    tmpextin='.2', tmpextout='.3', sep='\t', strategy='index'):
+    runStage(iterOverlapWithTfbsConsSites, vcf, tmpextin, tmpextout,
+        sep=sep, format=format, table=table, strategy=strategy)
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
+def iterOverlapWithGadAll(records, cursor, log, format='vcf',
+    table='gadAll', strategy='point', snapshot_dir=None, cache=None,
+    concurrency=1, pool=None):
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    index = open_index(cursor, table, strategy, chrom_col='chromosome',
+        snapshot_dir=snapshot_dir, cache=cache,
+        concurrency=concurrency, pool=pool)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    # For some reason this table has no "chr" preceeding number
+    key = lambda fields: lookupKey(fields, inds, prefix=False)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    for fields, rows in lookupRecords(records, index, key):
+        if isHeader(fields):
+            yield fields
+            continue
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        found = []
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if (len(rows) > 0):
+            records_count = 1
+            line_count = line_count + 1
+            r_tmp = set([])
+            for row in rows:
+                var_count = var_count + 1
+                if str(row[3]) not in r_tmp:
+                    r_tmp.add(str(row[3]))
+                    found.append(str(table) + '=' + str(row[3]))
+                    records_count = records_count + 1
+            info = recordInfo(fields)
+            info.extend(';'.join(found))
+            # Annotated records have always been written out with '\t '
+            # between the fields; keep the output unchanged
+            info.prepend(' ')
+            fields[1:] = [f if (f is info) else ' ' + f for f in fields[1:]]
+            if (len(fields) > RECORD_FIELDS):
+                fields[RECORD_FIELDS] = \
+                    fields[RECORD_FIELDS].replace('\t', '\t ')
+
+        yield fields
+
+    log.add(renderOverlapCounts, table, var_count=var_count,
+        line_count=line_count)
+    addCacheCounts(log, cache, table)
+    index.close()
+
+
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
+    tmpextout='.1', sep='\t', strategy='point'):
+    runStage(iterOverlapWithGadAll, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table, strategy=strategy)
 
 
 """ Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def iterOverlapWithGwasCatalog(records, cursor, log, format='vcf',
+    table='gwasCatalog', strategy='index', snapshot_dir=None, cache=None,
+    concurrency=1, pool=None):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    # Point lookup on chromEnd, i.e. a zero-length interval
+    index = open_index(cursor, table, strategy, start_col='chromEnd',
+        end_col='chromEnd', snapshot_dir=snapshot_dir, cache=cache,
+        concurrency=concurrency, pool=pool)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    key = lambda fields: lookupKey(fields, inds)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    for fields, rows in lookupRecords(records, index, key):
+        if isHeader(fields):
+            yield fields
+            continue
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        found = []
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if (len(rows) > 0):
+            line_count = line_count + 1
+            records_count = 1
+            for row in rows:
+                var_count = var_count + 1
+                found.append(str(table) + '=' + str('pubMedID') + \
+                    '=' + str(row[5]) + ',trait=' + str(row[10]))
+                records_count = records_count + 1
+            recordInfo(fields).extend(';'.join(found))
+
+        yield fields
+
+    log.add(renderOverlapCounts, table, var_count=var_count,
+        line_count=line_count)
+    addCacheCounts(log, cache, table)
+    index.close()
+
+
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t', strategy='index'):
+    runStage(iterOverlapWithGwasCatalog, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table, strategy=strategy)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+def iterOverlapWitHUGOGeneNomenclature(records, cursor, log, format='vcf',
+    table='hugo', strategy='index', snapshot_dir=None, cache=None,
+    concurrency=1, pool=None):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    index = open_index(cursor, table, strategy, snapshot_dir=snapshot_dir,
+        cache=cache, concurrency=concurrency, pool=pool)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    key = lambda fields: lookupKey(fields, inds)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    for fields, rows in lookupRecords(records, index, key):
+        if isHeader(fields):
+            yield fields
+            continue
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        found = []
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if (len(rows) > 0):
+            line_count = line_count + 1
+            records_count = 1
+            r_tmp = set([])
+            for row in rows:
+                var_count = var_count + 1
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if t not in r_tmp:
+                    r_tmp.add(t)
+                    found.append('HGNC_GeneAnnotation' + '=' + t)
+                records_count = records_count + 1
+
+            records_str = ','.join(found).replace(';', ',')
+
+            recordInfo(fields).extend(records_str)
+
+        yield fields
+
+    log.add(renderOverlapCounts, table, var_count=var_count,
+        line_count=line_count)
+    addCacheCounts(log, cache, table)
+    index.close()
+
+
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
+    tmpextin='', tmpextout='.1', sep='\t', strategy='index'):
+    runStage(iterOverlapWitHUGOGeneNomenclature, vcf, tmpextin, tmpextout,
+        sep=sep, format=format, table=table, strategy=strategy)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+def iterOverlapWithGenomicSuperDups(records, cursor, log, format='vcf',
+    table='genomicSuperDups', strategy='index', snapshot_dir=None,
+    cache=None, concurrency=1, pool=None):
+
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    index = open_index(cursor, table, strategy, snapshot_dir=snapshot_dir,
+        cache=cache, concurrency=concurrency, pool=pool)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    key = lambda fields: lookupKey(fields, inds)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    for fields, rows in lookupRecords(records, index, key, first=True):
+        if isHeader(fields):
+            yield fields
+            continue
+
+        isOverlap = False
+        otherChrom = ''
+        otherStart = ''
+        otherEnd = ''
+
+        if rows is not None:
+            line_count = line_count + 1
+            var_count = var_count + 1
+            isOverlap = True
+            otherChrom = rows[7]
+            otherStart = rows[8]
+            otherEnd = rows[9]
+            recordInfo(fields).append(str(table) + '=' + \
+                str(isOverlap) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
+
+        yield fields
+
+    log.add(renderOverlapCounts, table, var_count=var_count,
+        line_count=line_count)
+    addCacheCounts(log, cache, table)
+    index.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
+def addOverlapWithGenomicSuperDups(vcf, format='vcf',
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t', strategy='index'):
+    runStage(iterOverlapWithGenomicSuperDups, vcf, tmpextin, tmpextout,
+        sep=sep, format=format, table=table, strategy=strategy)
 
-"""Searches Genes Databases and returns Genes/Cytobands 
+
+"""Searches Genes Databases and returns Genes/Cytobands
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+def iterOverlapWithRefGene(records, cursor, log, format='vcf',
+    table='refGene'):
+
     var_count = 0
     line_count = 0
     colindex = 1
@@ -1132,74 +1381,58 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     endName = 'txEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
+    for fields in records:
+        if isHeader(fields):
+            yield fields
+            continue
+
+        chr = fields[inds[0]].strip()
+        if not chr.startswith("chr"):
+            chr = "chr" + chr
+
+        pos = fields[inds[1]].strip()
+
+        sql = 'select * from ' + table + ' where chrom = ? AND '
+        bins = []
+        if (BIN_COL in table_columns(cursor, table)):
+            condition, bins = bin_condition(BIN_COL, pos, pos)
+            sql = sql + condition + ' AND '
+        sql = sql + '(' + startName + ' <= ? AND ? <= ' + endName + ')' + \
+            order_clause(row_order(cursor, table)) + ';'
+        overlapsWith = []
+        q.execute(cursor, sql, [str(chr)] + bins + [int(pos), int(pos)])
+        rows = cursor.fetchall()
+
+        if (len(rows) > 0):
+            line_count = line_count + 1
+            for row in rows:
+                var_count = var_count + 1
+                overlapsWith.append(name2 + '=' + \
+                    str(row[colindex2]) + ';' + name + '=' + \
+                    str(row[colindex]))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+            genes = ';'.join([str(x) for x in overlapsWith])
+            recordInfo(fields).extend(str(genes))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        yield fields
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    log.add(renderOverlapCounts, table, var_count=var_count,
+        line_count=line_count)
+
+
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(iterOverlapWithRefGene, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table)
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
+def iterOverlapWithCytoband(records, cursor, log, format='vcf',
+    table='cytoBand', strategy='index', snapshot_dir=None, cache=None,
+    concurrency=1, pool=None):
+
     var_count = 0
     line_count = 0
     colindex = 12
@@ -1212,192 +1445,124 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
         endName = 'chromEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    index = open_index(cursor, table, strategy, start_col=startName,
+        end_col=endName, snapshot_dir=snapshot_dir, cache=cache,
+        concurrency=concurrency, pool=pool)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
+    key = lambda fields: lookupKey(fields, inds)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    for fields, rows in lookupRecords(records, index, key):
+        if isHeader(fields):
+            yield fields
+            continue
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        overlapsWith = []
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if (len(rows) > 0):
+            line_count = line_count + 1
+            for row in rows:
+                var_count = var_count + 1
+                overlapsWith.append(str(row[colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+
+            recordInfo(fields).extend(str(table) + '=' + str(cytoband))
+
+        yield fields
+
+    log.add(renderOverlapCounts, table, var_count=var_count,
+        line_count=line_count)
+    addCacheCounts(log, cache, table)
+    index.close()
+
+
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
+    tmpextin='', tmpextout='.1', sep='\t', strategy='index'):
+    runStage(iterOverlapWithCytoband, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table, strategy=strategy)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def iterOverlapWithCnvDatabase(records, cursor, log, format='vcf',
+    table='dgv_Cnv', strategy='index', snapshot_dir=None, cache=None,
+    concurrency=1, pool=None):
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    index = open_index(cursor, table, strategy, snapshot_dir=snapshot_dir,
+        cache=cache, concurrency=concurrency, pool=pool)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
+    key = lambda fields: lookupKey(fields, inds)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    for fields, rows in lookupRecords(records, index, key, first=True):
+        if isHeader(fields):
+            yield fields
+            continue
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        isOverlap = False
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        if rows is not None:
+            line_count = line_count + 1
+            var_count = var_count + 1
+            isOverlap = True
+            recordInfo(fields).extend(str(table) + '=' + str(isOverlap))
+
+        yield fields
+
+    log.add(renderOverlapCounts, table, var_count=var_count,
+        line_count=line_count)
+    addCacheCounts(log, cache, table)
+    index.close()
+
+
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
+    tmpextin='', tmpextout='.1', sep='\t', strategy='index'):
+    runStage(iterOverlapWithCnvDatabase, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table, strategy=strategy)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def iterOverlapWithMiRNA(records, cursor, log, format='vcf',
+    table='targetScanS', strategy='index', snapshot_dir=None, cache=None,
+    concurrency=1, pool=None):
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
     var_count = 0
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    index = open_index(cursor, table, strategy, snapshot_dir=snapshot_dir,
+        cache=cache, concurrency=concurrency, pool=pool)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
+    key = lambda fields: lookupKey(fields, inds)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    for fields, rows in lookupRecords(records, index, key, first=True):
+        if isHeader(fields):
+            yield fields
+            continue
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        if rows is not None:
+            line_count = line_count + 1
+            var_count = var_count + 1
+            t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
+                str(rows[2]) + '_' + str(rows[3])
+            t = 'miRNAsites=' + t.strip()
+            recordInfo(fields).extend(t)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        yield fields
+
+    log.add(renderOverlapCounts, 'miRNAsites', var_count=var_count,
+        line_count=line_count)
+    addCacheCounts(log, cache, table)
+    index.close()
+
+
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
+    tmpextin='', tmpextout='.1', sep='\t', strategy='index'):
+    runStage(iterOverlapWithMiRNA, vcf, tmpextin, tmpextout, sep=sep,
+        format=format, table=table, strategy=strategy)
 
 ### EOF
\ No newline at end of file
@@ -38,12 +38,44 @@ table = dynamodb.Table(config['aws']['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
 sqs = boto3.resource("sqs", region_name=config['aws']['AWS_REGION_NAME'])
 queue = sqs.get_queue_by_name(QueueName=config['aws']['AWS_SQS_JOB_REQUEST_QUEUE_NAME'])
 
+#Reference snapshot shared by all jobs on this host (see snapshot.py); only
+#the snapshot and auto lookup strategies read it
+snapshot_dir = config.get('ann', 'SNAPSHOT_DIR')
+if config.get('ann', 'LOOKUP_STRATEGY') not in ('snapshot', 'auto'):
+    snapshot_dir = ''
+snapshot_max_age = config.getint('ann', 'SNAPSHOT_MAX_AGE')
+snapshot_refresh = None
+
+def refresh_snapshot():
+    """
+    Rebuild the reference snapshot in the background once it is too old.
+    Jobs keep reading the current one until the new one is published.
+    """
+    global snapshot_refresh
+    if snapshot_refresh is not None and snapshot_refresh.poll() is None:
+        return
+    try:
+        if snapshot.is_stale(snapshot_dir, snapshot_max_age):
+            snapshot_refresh = subprocess.Popen(["python", "snapshot.py",
+                "--max-age", str(snapshot_max_age), snapshot_dir])
+            logger.info("Refreshing reference snapshot.")
+    except Exception as e:
+        logger.error(f"Failed to refresh reference snapshot: {e}")
+
 ################################################################################
 # MAIN
 ################################################################################
 
+if snapshot_dir:
+    #Publish the snapshot before any job needs it
+    import snapshot
+    snapshot.publish(snapshot_dir, snapshot_max_age)
+    logger.info(f"Reference snapshot published in {snapshot_dir}.")
+
 logger.info('Checking for annotation requests...')
 while True:
+    if snapshot_dir:
+        refresh_snapshot()
     # Attempt to read a message from the queue
     try:
         messages = queue.receive_messages(WaitTimeSeconds=20)
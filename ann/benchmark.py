@@ -0,0 +1,490 @@
+# benchmark.py
+#
+# Benchmarks of the annotation pipeline against the reference database
+#
+# Usage: python benchmark.py bins <vcf> [table ...]
+#        python benchmark.py statements <vcf> [table ...]
+#        python benchmark.py wide <vcf> [samples]
+#        python benchmark.py io <vcf> [lines]
+#        python benchmark.py helpers <vcf> [repeat]
+#        python benchmark.py gzip <vcf> [megabytes]
+#
+#   bins - rows examined and time of the per-variant point queries, with
+#          and without the UCSC bin condition (interval_index.PointQuery)
+#   statements - the same point queries with their values pasted into the
+#          SQL, as the annotator used to build them, and as parameterized
+#          queries (query.py), with their distinct texts. The server
+#          parses and plans every execution either way: pymysql
+#          substitutes the parameters on the client, and the server_
+#          columns (Com_stmt_*) show that nothing is prepared
+#   wide - time of reading, annotating INFO and writing back the records
+#          of the VCF widened to samples (default 1000) sample columns,
+#          once per stage of the sequential pipeline, splitting every
+#          field against the first annotate.RECORD_FIELDS only; needs no
+#          database
+#   io - MB/s and peak memory of one read/annotate/write pass over the
+#          records of the VCF repeated to lines (default 1000000) lines,
+#          with the text reader and writer of the stages and with a bytes
+#          one (rb/wb, only CHROM to INFO decoded, the sample block kept
+#          as a memoryview of the line); needs no database
+#   helpers - microseconds per call of the helpers on the per-variant path
+#          (INFO parsing, deduplication, complements, chromosome filter),
+#          fed with the fields of the VCF; needs no database
+#   gzip - bytes read and written and wall time of one read/annotate/write
+#          pass over the VCF repeated to megabytes (default 1000) MB, from
+#          plain and BGZF input to plain and BGZF output (bgzf.py); needs
+#          no database
+#
+# Rows examined are the sums of the Handler_read_* session counters of
+# MySQL over the queries of each run.
+#
+##
+
+import os
+import sys
+import time
+import timeit
+import tempfile
+import tracemalloc
+
+import utils as u
+import query as q
+import annotate as ann
+import bgzf
+import pileup2vcf
+from interval_index import PointQuery
+
+# Tables of the bins benchmark: column overrides and the offset around the
+# position the annotator looks up (refGene: promoter offset of getGenes)
+BIN_TABLES = [
+    ('refGene', dict(start_col='txStart', end_col='txEnd'), 500),
+    ('cpgIslandExt', dict(), 0),
+    ('gwasCatalog', dict(start_col='chromEnd', end_col='chromEnd'), 0),
+    ('targetScanS', dict(), 0),
+    ('hugo', dict(), 0),
+    ('dgv_Cnv', dict(), 0),
+    ('genomicSuperDups', dict(), 0),
+]
+
+
+"""(chrom, pos) of the variants of a VCF, chrom with the chr prefix
+"""
+def read_positions(vcf):
+    positions = []
+    with open(vcf) as fh:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            chrom = fields[0].strip()
+            if not chrom.startswith('chr'):
+                chrom = 'chr' + chrom
+            positions.append((chrom, int(fields[1])))
+    return positions
+
+
+def handler_reads(cursor):
+    cursor.execute("show session status like 'Handler_read%';")
+    return sum([int(row[1]) for row in cursor.fetchall()])
+
+
+"""Runs every lookup once through index; returns (rows examined, rows
+   returned, seconds)
+"""
+def run_lookups(cursor, index, positions, offset):
+    returned = 0
+    before = handler_reads(cursor)
+    start = time.time()
+    for chrom, pos in positions:
+        returned = returned + len(index.overlaps(chrom, pos - offset,
+            pos + offset))
+    secs = time.time() - start
+    # The status query reads a handful of rows itself
+    examined = handler_reads(cursor) - before
+    return examined, returned, secs
+
+
+def bench_bins(vcf, tables=None):
+    positions = read_positions(vcf)
+    conn = u.db_connect()
+    cursor = conn.cursor()
+
+    print(f"{len(positions)} lookups per table")
+    print('\t'.join(['table', 'bins', 'examined', 'returned', 'seconds']))
+    for table, kwargs, offset in BIN_TABLES:
+        if (tables and table not in tables):
+            continue
+        for bin_col in [None, 'bin']:
+            index = PointQuery(cursor, table, bin_col=bin_col, **kwargs)
+            examined, returned, secs = run_lookups(cursor, index,
+                positions, offset)
+            print('\t'.join([table, 'yes' if bin_col else 'no',
+                str(examined), str(returned), f"{secs:.2f}"]))
+
+    conn.close()
+
+
+"""Runs statements with their parameters pasted into the SQL text, and
+   counts the distinct texts
+"""
+class InlineCursor(object):
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.texts = set([])
+        self.executed = 0
+
+    def execute(self, sql, params=()):
+        parts = sql.split('%s')
+        sql = parts[0]
+        for value, part in zip(params, parts[1:]):
+            if isinstance(value, str):
+                value = '"' + value.replace('"', '') + '"'
+            sql = sql + str(value) + part
+        self.texts.add(sql)
+        self.executed = self.executed + 1
+        self.cursor.execute(sql)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+
+"""Com_stmt_prepare and Com_stmt_execute, the statements the server has
+   prepared and executed in this session
+"""
+def statement_counters(cursor):
+    cursor.execute("show session status like 'Com_stmt_%';")
+    counters = dict([(str(row[0]).lower(), int(row[1]))
+        for row in cursor.fetchall()])
+    return counters.get('com_stmt_prepare', 0), \
+        counters.get('com_stmt_execute', 0)
+
+
+def bench_statements(vcf, tables=None):
+    positions = read_positions(vcf)
+    conn = u.db_connect()
+    cursor = conn.cursor()
+
+    print(f"{len(positions)} lookups per table")
+    print('\t'.join(['table', 'sql', 'executed', 'distinct_texts',
+        'repeated', 'server_prepared', 'server_executed', 'seconds']))
+    for table, kwargs, offset in BIN_TABLES:
+        if (tables and table not in tables):
+            continue
+
+        inline = InlineCursor(cursor)
+        index = PointQuery(inline, table, bin_col='bin', **kwargs)
+        before = statement_counters(cursor)
+        start = time.time()
+        for chrom, pos in positions:
+            index.overlaps(chrom, pos - offset, pos + offset)
+        secs = time.time() - start
+        after = statement_counters(cursor)
+        print('\t'.join([table, 'inline', str(inline.executed),
+            str(len(inline.texts)), str(inline.executed - len(inline.texts)),
+            str(after[0] - before[0]), str(after[1] - before[1]),
+            f"{secs:.2f}"]))
+
+        q.reset_counts()
+        index = PointQuery(cursor, table, bin_col='bin', **kwargs)
+        before = statement_counters(cursor)
+        start = time.time()
+        for chrom, pos in positions:
+            index.overlaps(chrom, pos - offset, pos + offset)
+        secs = time.time() - start
+        after = statement_counters(cursor)
+        counts = q.counts()
+        print('\t'.join([table, 'parameterized', str(counts['executed']),
+            str(counts['distinct_texts']),
+            str(counts['executed'] - counts['distinct_texts']),
+            str(after[0] - before[0]), str(after[1] - before[1]),
+            f"{secs:.2f}"]))
+
+    conn.close()
+
+
+# Stages of the sequential pipeline, each reading and writing the file
+STAGE_PASSES = 14
+
+
+"""Copy of vcf with samples genotype columns
+"""
+def widen(vcf, path, samples):
+    genotypes = '\t'.join(['0/1' if (i % 3) else '0/0'
+        for i in range(0, samples)])
+    names = '\t'.join(['S' + str(i) for i in range(0, samples)])
+    with open(vcf) as fh, open(path, 'w') as fh_out:
+        for line in fh:
+            fields = line.rstrip('\n').split('\t')
+            if line.startswith('##'):
+                fh_out.write(line)
+            elif line.startswith('#'):
+                fh_out.write('\t'.join(fields[:8] + ['FORMAT', names]) + '\n')
+            else:
+                fh_out.write('\t'.join(fields[:8] + ['GT', genotypes]) +
+                    '\n')
+
+
+"""readRecords as it was, splitting every field
+"""
+def read_all_fields(fh, sep='\t'):
+    for line in fh:
+        line = line.strip()
+        if (line.startswith('#') or line.startswith('CHROM')):
+            yield line
+        else:
+            yield line.split(sep)
+
+
+def annotate_info(records):
+    for fields in records:
+        if not ann.isHeader(fields):
+            fields[7] = fields[7] + ';X=1'
+        yield fields
+
+
+"""Seconds of STAGE_PASSES read/annotate/write passes from path with
+   read; returns them with the final file
+"""
+def run_passes(path, read):
+    start = time.time()
+    for i in range(0, STAGE_PASSES):
+        with open(path) as fh, open(path + '.' + str(i), 'w') as fh_out:
+            ann.writeRecords(annotate_info(read(fh)), fh_out)
+        if (i > 0):
+            os.remove(path)
+        path = path + '.' + str(i)
+    return time.time() - start, path
+
+
+def bench_wide(vcf, args=None):
+    samples = int(args[0]) if args else 1000
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'wide.vcf')
+    widen(vcf, path, samples)
+    print(f"{samples} samples, {os.path.getsize(path)} bytes, " +
+        f"{STAGE_PASSES} passes")
+
+    print('\t'.join(['split', 'seconds']))
+    outputs = []
+    for name, read in [('all fields', read_all_fields),
+        ('first ' + str(ann.RECORD_FIELDS), ann.readRecords)]:
+        secs, out = run_passes(path, read)
+        print('\t'.join([name, f"{secs:.2f}"]))
+        with open(out) as fh:
+            outputs.append(fh.read())
+        os.remove(out)
+
+    os.remove(path)
+    os.rmdir(directory)
+    if (outputs[0] != outputs[1]):
+        print("Outputs differ")
+
+
+"""Copy of vcf with its records repeated to lines records
+"""
+def lengthen(vcf, path, lines):
+    with open(vcf) as fh:
+        headers = [line for line in fh if line.startswith('#')]
+    with open(vcf) as fh:
+        records = [line for line in fh if not line.startswith('#')]
+    with open(path, 'w') as fh_out:
+        fh_out.writelines(headers)
+        for i in range(0, lines):
+            fh_out.write(records[i % len(records)])
+
+
+def text_pass(path, out):
+    with open(path, buffering=ann.IO_BUFFER_SIZE) as fh, \
+        open(out, 'w', buffering=ann.IO_BUFFER_SIZE) as fh_out:
+        ann.writeRecords(annotate_info(ann.readRecords(fh)), fh_out)
+
+
+"""ann.readRecords over a file opened in binary mode
+"""
+def read_bytes(fh):
+    for line in fh:
+        line = line.strip()
+        if (line.startswith(b'#') or line.startswith(b'CHROM')):
+            yield line.decode()
+            continue
+        fields = line.split(b'\t', ann.RECORD_FIELDS)
+        if (len(fields) > ann.RECORD_FIELDS):
+            head = len(line) - len(fields[-1])
+            fields = line[:head - 1].decode().split('\t')
+            fields.append(memoryview(line)[head:])
+        else:
+            fields = line.decode().split('\t')
+        yield fields
+
+
+def write_bytes(records, fh_out):
+    for record in records:
+        if ann.isHeader(record):
+            fh_out.write(record.encode() + b'\n')
+        elif (len(record) > ann.RECORD_FIELDS):
+            fh_out.write('\t'.join(record[:ann.RECORD_FIELDS]).encode() +
+                b'\t')
+            fh_out.write(record[ann.RECORD_FIELDS])
+            fh_out.write(b'\n')
+        else:
+            fh_out.write('\t'.join(record).encode() + b'\n')
+
+
+def bytes_pass(path, out):
+    with open(path, 'rb', buffering=ann.IO_BUFFER_SIZE) as fh, \
+        open(out, 'wb', buffering=ann.IO_BUFFER_SIZE) as fh_out:
+        write_bytes(annotate_info(read_bytes(fh)), fh_out)
+
+
+def bench_io(vcf, args=None):
+    lines = int(args[0]) if args else 1000000
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'long.vcf')
+    lengthen(vcf, path, lines)
+    size = os.path.getsize(path)
+    print(f"{lines} lines, {size} bytes")
+
+    print('\t'.join(['io', 'MB/s', 'peak_kb']))
+    outputs = []
+    for name, run in [('text', text_pass), ('bytes', bytes_pass)]:
+        out = path + '.' + name
+        start = time.time()
+        run(path, out)
+        secs = time.time() - start
+        # Traced apart, tracemalloc slows the pass down
+        tracemalloc.start()
+        run(path, out)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('\t'.join([name, f"{size / secs / 1e6:.1f}",
+            str(peak // 1024)]))
+        with open(out, 'rb') as fh:
+            outputs.append(fh.read())
+        os.remove(out)
+
+    os.remove(path)
+    os.rmdir(directory)
+    if (outputs[0] != outputs[1]):
+        print("Outputs differ")
+
+
+"""(name, function) of the helper microbenchmarks over the records of
+   vcf; each function makes one pass over them
+"""
+def helper_cases(vcf):
+    with open(vcf) as fh:
+        records = [fields for fields in ann.readRecords(fh)
+            if not ann.isHeader(fields)]
+    infos = [fields[7] + ';name=NM_1;positionType=CDS' for fields in records]
+    refs = [fields[3] for fields in records]
+    chroms = [fields[0] for fields in records]
+    names = ['GENE' + str(i % 7) for i in range(0, 50)]
+
+    def parse_info():
+        for info in infos:
+            pairs = u.parse_fields(info, ';', '=')
+            u.find_field(pairs, 'name')
+            u.find_field(pairs, 'positionType')
+
+    def complements():
+        for ref in refs:
+            ann.getComplementary(ref)
+
+    def accepted_chroms():
+        for chrom in chroms:
+            chrom.strip() in pileup2vcf.ACCEPTED_CHR_SET
+
+    def dedup():
+        for i in range(0, len(records)):
+            u.dedup(names)
+
+    def info_builder():
+        for info in infos:
+            builder = ann.InfoBuilder(info)
+            for i in range(0, 14):
+                builder.extend('table' + str(i) + '=True')
+            str(builder)
+
+    return [('parse_field', parse_info), ('getComplementary', complements),
+        ('ACCEPTED_CHR', accepted_chroms), ('dedup', dedup),
+        ('InfoBuilder', info_builder)], len(records)
+
+
+def bench_helpers(vcf, args=None):
+    repeat = int(args[0]) if args else 5
+    cases, records = helper_cases(vcf)
+    print(f"{records} records, best of {repeat}")
+    print('\t'.join(['helper', 'us_per_record']))
+    for name, case in cases:
+        secs = min(timeit.repeat(case, number=1, repeat=repeat))
+        print('\t'.join([name, f"{secs / max(records, 1) * 1e6:.3f}"]))
+
+
+def gzip_pass(path, out, compress):
+    with bgzf.open_input(path, buffering=ann.IO_BUFFER_SIZE) as fh, \
+        bgzf.open_output(out, compress, ann.IO_BUFFER_SIZE) as fh_out:
+        ann.writeRecords(annotate_info(ann.readRecords(fh)), fh_out)
+
+
+def bench_gzip(vcf, args=None):
+    megabytes = int(args[0]) if args else 1000
+    with open(vcf) as fh:
+        records = [line for line in fh if not line.startswith('#')]
+    lines = megabytes * 1000000 * len(records) // \
+        max(sum([len(line) for line in records]), 1)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'long.vcf')
+    lengthen(vcf, path, lines)
+    start = time.time()
+    with open(path, 'rb') as fh, bgzf.BgzfWriter(path + '.gz') as fh_out:
+        for block in iter(lambda: fh.read(ann.IO_BUFFER_SIZE), b''):
+            fh_out.write(block)
+    print(f"{lines} lines, {os.path.getsize(path)} bytes, compressed in " +
+        f"{time.time() - start:.1f} s")
+
+    print('\t'.join(['input', 'output', 'in_MB', 'out_MB', 'moved_MB',
+        'secs']))
+    for source in [path, path + '.gz']:
+        for compress in [False, True]:
+            out = path + '.annot' + ('.gz' if compress else '')
+            start = time.time()
+            gzip_pass(source, out, compress)
+            secs = time.time() - start
+            size_in = os.path.getsize(source)
+            size_out = os.path.getsize(out)
+            print('\t'.join(['vcf.gz' if bgzf.is_compressed(source) else
+                'vcf', 'vcf.gz' if compress else 'vcf',
+                f"{size_in / 1e6:.1f}", f"{size_out / 1e6:.1f}",
+                f"{(size_in + size_out) / 1e6:.1f}", f"{secs:.1f}"]))
+            os.remove(out)
+
+    os.remove(path)
+    os.remove(path + '.gz')
+    os.rmdir(directory)
+
+
+COMMANDS = {
+    'bins': bench_bins,
+    'statements': bench_statements,
+    'wide': bench_wide,
+    'io': bench_io,
+    'helpers': bench_helpers,
+    'gzip': bench_gzip,
+}
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2 and sys.argv[1] in COMMANDS):
+        COMMANDS[sys.argv[1]](sys.argv[2], sys.argv[3:] or None)
+    else:
+        print("Usage: python benchmark.py bins|statements <vcf> [table ...]")
+        print("       python benchmark.py wide <vcf> [samples]")
+        print("       python benchmark.py io <vcf> [lines]")
+        print("       python benchmark.py helpers <vcf> [repeat]")
+        print("       python benchmark.py gzip <vcf> [megabytes]")
+
+### EOF
\ No newline at end of file
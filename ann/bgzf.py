@@ -0,0 +1,99 @@
+# bgzf.py
+#
+# Compressed VCF input and BGZF output
+#
+# Inputs ending in .gz or .bgz are decompressed as a stream by the gzip
+# module, which reads both plain gzip and BGZF (a series of gzip members).
+#
+# Results can be written as BGZF: gzip members of at most BLOCK_SIZE bytes
+# of data each, with the block size in a "BC" extra field and an empty
+# block at the end, as tabix, bcftools and htslib expect. A BGZF file is
+# still a valid gzip file, and a reader can seek to any block of it.
+#
+##
+
+import io
+import gzip
+import zlib
+import struct
+
+COMPRESSED_EXTENSIONS = ('.gz', '.bgz')
+# Data per block; htslib uses the same, which keeps every compressed block
+# under 64 KB even when the data does not compress
+BLOCK_SIZE = 0xff00
+COMPRESS_LEVEL = 6
+
+# Header of a block, up to the size of the block less one
+_HEADER = struct.pack('<4BIBBHBBH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+    ord('B'), ord('C'), 2)
+# Empty block closing every BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b00' +
+    '03000000000000000000')
+
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED_EXTENSIONS)
+
+
+"""Opens path for reading, decompressing it if it is a .gz or .bgz file
+   mode is 'r' (text) or 'rb'
+"""
+def open_input(path, mode='r', buffering=-1):
+    if not is_compressed(path):
+        return open(path, mode, buffering=buffering)
+    if (mode == 'rb'):
+        return gzip.open(path, 'rb')
+    return io.TextIOWrapper(gzip.open(path, 'rb'))
+
+
+"""BGZF block of data, at most BLOCK_SIZE bytes
+"""
+def compress_block(data, level=COMPRESS_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    return _HEADER + struct.pack('<H', len(_HEADER) + 2 + len(deflated) +
+        8 - 1) + deflated + struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+        len(data))
+
+
+"""Binary file object writing BGZF blocks to a file
+"""
+class BgzfWriter(io.RawIOBase):
+
+    def __init__(self, path, level=COMPRESS_LEVEL):
+        self.fh = open(path, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.bytes_in = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.bytes_in = self.bytes_in + len(data)
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.fh.write(compress_block(bytes(self.buffer[:BLOCK_SIZE]),
+                self.level))
+            del self.buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if (len(self.buffer) > 0):
+            self.fh.write(compress_block(bytes(self.buffer), self.level))
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+        super(BgzfWriter, self).close()
+
+
+"""Opens path for writing text, as BGZF if compress
+"""
+def open_output(path, compress=False, buffering=-1):
+    if not compress:
+        return open(path, 'w', buffering=buffering)
+    return io.TextIOWrapper(io.BufferedWriter(BgzfWriter(path),
+        buffer_size=BLOCK_SIZE))
+
+### EOF
@@ -0,0 +1,157 @@
+# dbsnp_filter.py
+#
+# Bloom filter of the (CHR, POS) keys of dbSNP, to skip the queries of
+# variants that cannot be in it
+#
+# Usage: python dbsnp_filter.py [--build <name>] [--fp-rate <rate>] <file>
+#
+# The file starts with a JSON header of HEADER_SIZE bytes (dbSNP build,
+# number of keys, bits, hash functions and false-positive rates) followed
+# by the bit array. It is memory-mapped read-only, so the jobs and worker
+# processes of a host share one copy through the page cache; a rebuild
+# writes a new file and renames it over the old one.
+#
+# A lookup answers "maybe" for every key in dbSNP and for a fraction
+# fp_rate of the others, never "no" for a key in dbSNP: variants it turns
+# down need no query.
+#
+##
+
+import os
+import json
+import math
+import mmap
+import time
+import argparse
+import hashlib
+
+import utils as u
+import query as q
+
+HEADER_SIZE = 4096
+DEFAULT_FP_RATE = 0.01
+DEFAULT_BUILD = 'dbSNP135'
+# Positions fetched per query while building
+FETCH_SIZE = 100000
+
+
+"""Key of a dbSNP row or variant; CHR is compared as MySQL does, without
+   regard to case
+"""
+def key(chrom, pos):
+    return (str(chrom).strip().upper() + ':' + str(int(pos))).encode()
+
+
+"""Bit positions of key among bits, by double hashing
+"""
+def bit_positions(key, bits, hashes):
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % bits for i in range(0, hashes)]
+
+
+"""Bits and hash functions holding keys at fp_rate
+"""
+def filter_size(keys, fp_rate):
+    keys = max(keys, 1)
+    bits = int(math.ceil(-keys * math.log(fp_rate) / (math.log(2) ** 2)))
+    bits = (bits + 7) // 8 * 8
+    hashes = max(1, int(round(bits / keys * math.log(2))))
+    return bits, hashes
+
+
+def expected_fp_rate(keys, bits, hashes):
+    return (1 - math.exp(-hashes * keys / float(bits))) ** hashes
+
+
+"""(CHR, POS) of every dbSNP row, one chromosome at a time in position
+   order, FETCH_SIZE rows per query
+"""
+def dbsnp_keys(cursor):
+    q.execute(cursor, 'select distinct CHR from dbSNP;')
+    chroms = [row[0] for row in cursor.fetchall()]
+    for chrom in chroms:
+        last = -1
+        while True:
+            q.execute(cursor, 'select POS from dbSNP where CHR = ? AND ' +
+                'POS > ? order by POS limit ?;', (chrom, last, FETCH_SIZE))
+            positions = [int(row[0]) for row in cursor.fetchall()]
+            for pos in positions:
+                yield chrom, pos
+            if (len(positions) < FETCH_SIZE):
+                break
+            last = positions[-1]
+
+
+"""Writes the filter of the dbSNP table to path
+"""
+def build(path, dbsnp_build=DEFAULT_BUILD, fp_rate=DEFAULT_FP_RATE):
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    q.execute(cursor, 'select count(*) from dbSNP;')
+    rows = int(cursor.fetchone()[0])
+
+    bits, hashes = filter_size(rows, fp_rate)
+    array = bytearray(bits // 8)
+    for chrom, pos in dbsnp_keys(cursor):
+        for bit in bit_positions(key(chrom, pos), bits, hashes):
+            array[bit >> 3] |= 1 << (bit & 7)
+    conn.close()
+
+    header = dict(build=dbsnp_build, table='dbSNP', keys=rows, bits=bits,
+        hashes=hashes, fp_rate=fp_rate,
+        expected_fp_rate=expected_fp_rate(rows, bits, hashes),
+        created=time.strftime('%Y-%m-%d %H:%M:%S'))
+    header = json.dumps(header).encode()
+    if (len(header) >= HEADER_SIZE):
+        raise ValueError("dbSNP filter header too large")
+
+    with open(path + '.tmp', 'wb') as fh:
+        fh.write(header + b'\n' + b' ' * (HEADER_SIZE - len(header) - 1))
+        fh.write(array)
+    os.replace(path + '.tmp', path)
+    return json.loads(header)
+
+
+class DbSnpFilter(object):
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = json.loads(self.data[:HEADER_SIZE].decode())
+        self.bits = self.header['bits']
+        self.hashes = self.header['hashes']
+        if (len(self.data) != HEADER_SIZE + self.bits // 8):
+            raise ValueError(f"Truncated dbSNP filter {path}")
+
+    """False only if (chrom, pos) is not in dbSNP
+    """
+    def might_contain(self, chrom, pos):
+        data = self.data
+        for bit in bit_positions(key(chrom, pos), self.bits, self.hashes):
+            if not (data[HEADER_SIZE + (bit >> 3)] & (1 << (bit & 7))):
+                return False
+        return True
+
+    def close(self):
+        self.data.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Builds the Bloom filter of the dbSNP positions')
+    parser.add_argument('path')
+    parser.add_argument('--build', default=DEFAULT_BUILD,
+        help='dbSNP build recorded in the filter')
+    parser.add_argument('--fp-rate', type=float, default=DEFAULT_FP_RATE,
+        help='false-positive rate the filter is sized for')
+    args = parser.parse_args()
+
+    header = build(args.path, args.build, args.fp_rate)
+    print(f"{header['keys']} keys of {header['build']} in " +
+        f"{header['bits'] // 8} bytes, {header['hashes']} hashes, " +
+        f"false-positive rate {header['expected_fp_rate']:.4f}")
+
+### EOF
\ No newline at end of file
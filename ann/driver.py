@@ -12,110 +12,451 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor
 import file_utils as fu
+import utils as u
 import annotate as ann
+import bgzf
+from interval_index import choose_strategy
 
-def run(infile, format):
+"""Annotation stages in the order they are applied, as
+   (progress message, stage, stage keyword arguments)
+   strategy selects the lookup strategy of the region-overlap stages (see
+   interval_index.STRATEGIES); by default each stage uses its own, 'auto'
+   leaves the choice to chooseStrategies.
+   snapshot_dir is the directory written by snapshot.py, used by the
+   'snapshot' strategy. cache (a result_cache.ResultCache) is consulted by
+   the dbSNP and region-overlap stages before they query.
+   concurrency maps a table (or 'dbSNP', 'BigRefGene') to the number of
+   its queries kept in flight, 'default' to that of the others; see
+   parseConcurrency.
+   dbsnp_filter is the file written by dbsnp_filter.py, screening the
+   variants before they are looked up in dbSNP.
+"""
+def stages(dbsnp_batch_size=5000, strategy=None, snapshot_dir=None,
+    cache=None, concurrency=None, dbsnp_filter=None):
+    cached = dict(cache=cache) if cache else dict()
+    screened = dict(dbsnp_filter=dbsnp_filter) if dbsnp_filter else dict()
+    lookup = dict(strategy=strategy, **cached) if strategy else cached
+    if (strategy == 'snapshot'):
+        lookup['snapshot_dir'] = snapshot_dir
+    # The tfbsConsSites shards have no merge strategy
+    tfbs = cached if (strategy == 'merge') else lookup
+    # refGene and cpgIslandExt are snapshotted with the other tables
+    genes = dict()
+    if (strategy == 'snapshot'):
+        genes = dict(strategy=strategy, cpg_strategy=strategy,
+            snapshot_dir=snapshot_dir)
+    elif (strategy == 'auto'):
+        genes = dict(strategy=strategy, cpg_strategy=strategy)
+
+    concurrency = concurrency or {}
+    def inflight(table):
+        depth = concurrency.get(table, concurrency.get('default', 1))
+        return dict(concurrency=depth) if (depth > 1) else dict()
+
+    return [
+        ("dbSNP", ann.iterSnpsFromDbSnp,
+            dict(batch_size=dbsnp_batch_size, **cached, **screened,
+                **inflight('dbSNP'))),
+        ("BigRefGene", ann.iterBigRefGene, inflight('BigRefGene')),
+        ("BigRefGene", ann.iterGenes,
+            dict(table='refGene', promoter_offset=500, **genes)),
+        ("Cytoband", ann.iterOverlapWithCytoband,
+            dict(table='cytoBand', **lookup, **inflight('cytoBand'))),
+        ("gadAll", ann.iterOverlapWithGadAll,
+            dict(table='gadAll', **lookup, **inflight('gadAll'))),
+        ("GwasCatalog", ann.iterOverlapWithGwasCatalog,
+            dict(table='gwasCatalog', **lookup, **inflight('gwasCatalog'))),
+        ("miRNA", ann.iterOverlapWithMiRNA,
+            dict(table='targetScanS', **lookup, **inflight('targetScanS'))),
+        ("HUGO Gene Nomenclature Committee",
+            ann.iterOverlapWitHUGOGeneNomenclature,
+            dict(table='hugo', **lookup, **inflight('hugo'))),
+        ("dgv_Cnv", ann.iterOverlapWithCnvDatabase,
+            dict(table='dgv_Cnv', **lookup, **inflight('dgv_Cnv'))),
+        ("abParts_IG_T_CelReceptors", ann.iterOverlapWithCnvDatabase,
+            dict(table='abParts_IG_T_CelReceptors', **lookup,
+                **inflight('abParts_IG_T_CelReceptors'))),
+        ("mcCarroll_Cnv", ann.iterOverlapWithCnvDatabase,
+            dict(table='mcCarroll_Cnv', **lookup,
+                **inflight('mcCarroll_Cnv'))),
+        ("conrad_Cnv", ann.iterOverlapWithCnvDatabase,
+            dict(table='conrad_Cnv', **lookup, **inflight('conrad_Cnv'))),
+        ("genomicSuperDups", ann.iterOverlapWithGenomicSuperDups,
+            dict(table='genomicSuperDups', **lookup,
+                **inflight('genomicSuperDups'))),
+        ("addOverlapWithTfbsConsSites", ann.iterOverlapWithTfbsConsSites,
+            dict(table='tfbsConsSites', **tfbs, **inflight('tfbsConsSites'))),
+    ]
+
+
+"""Per-table query concurrency from its configuration, a string such as
+   'dbSNP=8, BigRefGene=4, default=1'
+"""
+def parseConcurrency(text):
+    concurrency = {}
+    for item in (text or '').split(','):
+        if (item.strip() != ''):
+            table, depth = item.split('=')
+            concurrency[table.strip()] = int(depth)
+    return concurrency
+
+
+"""Connections a run of pipeline holds at once: that of the stages, and
+   those of the queries every stage keeps in flight, as the fused stages
+   all run together
+"""
+def poolSize(pipeline):
+    return 1 + sum([kwargs.get('concurrency', 0)
+        for message, stage, kwargs in pipeline])
+
+
+"""Number of records and of distinct chromosomes in infile, in one pass
+   over its raw lines
+"""
+def countRecords(infile, format):
+    chr_ind = ann.getFormatSpecificIndices(format=format)[0]
+    records = 0
+    chroms = set([])
+
+    fh = bgzf.open_input(infile, 'rb')
+    for line in fh:
+        if (line.startswith(b'#') or line.startswith(b'CHROM')):
+            continue
+        records = records + 1
+        chroms.add(line.split(b'\t', chr_ind + 1)[chr_ind].strip())
+    fh.close()
+
+    return records, len(chroms)
+
+
+"""Replaces strategy='auto' in the stages of pipeline by the cheapest
+   strategy for the size of infile and of each table (see
+   interval_index.choose_strategy)
+   The gene structure stages look up one record at a time, where a window
+   holds a single variant, so they choose between point and index only.
+   Returns the new pipeline and a log of the choices.
+"""
+def chooseStrategies(pipeline, infile, format, pool, snapshot_dir=None):
+    records, chroms = countRecords(infile, format)
+    conn = pool.acquire()
+    cursor = conn.cursor()
+    log = ann.CountLog()
+    published = set([])
+    if snapshot_dir:
+        # Needs NumPy, only imported when snapshots are used
+        import snapshot
+        published = snapshot.published_tables(snapshot_dir)
+
+    def choose(table, sharded=False, strategies=('point', 'window', 'index')):
+        strategy, rows, costs = choose_strategy(cursor, table, records,
+            chroms, sharded=sharded, strategies=strategies)
+        if (table in published):
+            # Answered from the shared arrays, without a query
+            strategy = 'snapshot'
+            costs['snapshot'] = 0
+        log.add(ann.renderStrategyChoice, table, strategy=strategy,
+            records=records, rows=rows, **costs)
+        return strategy
+
+    chosen = []
+    for message, stage, kwargs in pipeline:
+        kwargs = dict(kwargs)
+        if (kwargs.get('strategy') == 'auto'):
+            if (stage in (ann.iterGenes, ann.iterExonsEtAl)):
+                kwargs['strategy'] = choose(kwargs['table'],
+                    strategies=('point', 'index'))
+            else:
+                kwargs['strategy'] = choose(kwargs['table'],
+                    sharded=(stage == ann.iterOverlapWithTfbsConsSites))
+        if (kwargs.get('cpg_strategy') == 'auto'):
+            kwargs['cpg_strategy'] = choose('cpgIslandExt',
+                strategies=('point', 'index'))
+        if ('snapshot' in (kwargs.get('strategy'),
+            kwargs.get('cpg_strategy'))):
+            kwargs['snapshot_dir'] = snapshot_dir
+        chosen.append((message, stage, kwargs))
+
+    pool.release(conn)
+    return chosen, log
+
+
+"""Runs the annotators over infile
+   dbsnp_batch_size is the number of records resolved per dbSNP query.
+   In fused mode every record is read once and passed through all stages
+   in memory; otherwise each stage writes a temporary file (infile.1, .2,
+   ...) that the next stage reads. Both produce the same output.
+   strategy='merge' sweeps coordinate-sorted input against the reference
+   tables; it falls back to indexed lookups if the input is not sorted, or
+   the table has no primary key to report the rows in table order by.
+   strategy='window' fetches one range per window of nearby records.
+   strategy='auto' picks point, window or index per table from the number
+   of records and the size of the table, or snapshot for the tables
+   published in snapshot_dir if one is given; the choices and their
+   estimated costs are added to the .count.log.
+   strategy='snapshot' resolves chunks of records against the NumPy arrays
+   snapshot.py exported to snapshot_dir.
+   With workers > 1 the input is split by chromosome into shard files,
+   which worker processes stream through all stages as the fused pipeline
+   does; neither the input nor the results are held in memory.
+   All stages share the connections of pool (a utils.ConnectionPool),
+   those of the queries they keep in flight included; one is opened for
+   the run if none is given, keeping poolSize of them. Worker processes
+   keep their own, opened with the connect callable of pool.
+   Results found in cache (a result_cache.ResultCache) are not queried
+   again; its hit counters are added to the .count.log.
+   concurrency sets the queries each table keeps in flight (see stages).
+   max_connections caps the database connections of the run: each worker
+   holds up to poolSize of them, and workers is lowered to fit (to 1, the
+   run in this process, at worst).
+   Variants the Bloom filter in dbsnp_filter rules out are not looked up
+   in dbSNP; the positions it left out of the queries are added to the
+   .count.log.
+   A .vcf.gz or .bgz infile is decompressed as it is read. With compress
+   the result is written as BGZF, to a .annot.vcf.gz file (see
+   resultName); the temporary files of the stages are not compressed.
+"""
+def run(infile, format, dbsnp_batch_size=5000, fused=False, strategy=None,
+    snapshot_dir=None, workers=1, pool=None, cache=None, concurrency=None,
+    dbsnp_filter=None, compress=False, max_connections=None):
 
     print("Running . . .")
+    pipeline = stages(dbsnp_batch_size=dbsnp_batch_size, strategy=strategy,
+        snapshot_dir=snapshot_dir, cache=cache, concurrency=concurrency,
+        dbsnp_filter=dbsnp_filter)
+
+    run_pool = u.ConnectionPool(size=poolSize(pipeline)) if (pool is None) \
+        else pool
+    choices = None
+    if (strategy == 'auto'):
+        pipeline, choices = chooseStrategies(pipeline, infile, format,
+            run_pool, snapshot_dir)
+
+    if (workers > 1 and max_connections):
+        fitting = max(1, max_connections // poolSize(pipeline))
+        if (fitting < workers):
+            print(f"{str(fitting)} workers fit in {str(max_connections)} " +
+                "connections")
+            workers = fitting
+
+    if (workers > 1):
+        runParallel(infile, format, pipeline, workers, compress,
+            run_pool.connect)
+    elif fused:
+        runFused(infile, format, pipeline, run_pool, compress)
+    else:
+        runSequential(infile, format, pipeline, run_pool, compress)
+    if (pool is None):
+        run_pool.close()
+
+    if (choices is not None):
+        fh_log = open(infile + '.count.log', 'a')
+        choices.write(fh_log)
+        fh_log.close()
+
+    os.rename(infile + '.annot', resultName(infile, compress))
+
+
+"""Name of the result of infile: in.vcf gives in.annot.vcf, in.vcf.gz,
+   in.vcf.bgz and in.bgz give in.annot.vcf, or in.annot.vcf.gz if compress
+"""
+def resultName(infile, compress=False):
+    name = infile
+    if bgzf.is_compressed(name):
+        name = name[:name.rfind('.')]
+        if not name.endswith('.vcf'):
+            name = name + '.vcf'
+    name = (name + '.annot').replace('.vcf.annot', '.annot.vcf')
+    return name + '.gz' if compress else name
+
+
+def runSequential(infile, format, pipeline, pool, compress=False):
+    tmpextin = ''
+    tmpextout = 1
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    for message, stage, kwargs in pipeline:
+        # The first stage starts a new .count.log, the last one writes the
+        # result
+        ann.runStage(stage, infile, tmpextin=tmpextin,
+            tmpextout='.' + str(tmpextout),
+            logmode='w' if (tmpextin == '') else 'a', pool=pool,
+            compress=compress and (tmpextout == len(pipeline)),
+            format=format, **kwargs)
+        print(message + " - done.")
+        tmpextin = '.' + str(tmpextout)
+        tmpextout = tmpextout + 1
 
     ## Cleanup
-    for i in range(1, tmpextin):
+    for i in range(1, tmpextout - 1):
         fu.delete(infile + '.' + str(i))
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    os.rename(infile + tmpextin, infile + '.annot')
+
+
+def runFused(infile, format, pipeline, pool, compress=False):
+    fh = bgzf.open_input(infile, buffering=ann.IO_BUFFER_SIZE)
+    fh_out = bgzf.open_output(infile + '.annot', compress,
+        buffering=ann.IO_BUFFER_SIZE)
+    conn = pool.acquire()
+    log = ann.CountLog()
+
+    records = ann.readRecords(fh)
+    for message, stage, kwargs in pipeline:
+        records = stage(records, conn.cursor(), log, format=format,
+            **ann.stageKwargs(kwargs, pool))
+    ann.writeRecords(records, fh_out)
+
+    for message, stage, kwargs in pipeline:
+        print(message + " - done.")
+
+    fh_log = open(infile + '.count.log', 'w')
+    log.write(fh_log)
+    fh_log.close()
+
+    pool.release(conn)
+    fh.close()
+    fh_out.close()
+
+
+"""Splits the records of infile into shard files infile.shard0, ...
+   Records are grouped by chromosome; a chromosome holding more than its
+   share of the records (1 / workers) is cut into contiguous chunks. The
+   input is streamed into the shard files, none of it is kept but the
+   header lines. Returns the paths of the shards and the order of the
+   input: header lines and [shard, records] runs.
+"""
+def splitShards(infile, format, workers):
+    chr_ind = ann.getFormatSpecificIndices(format=format)[0]
+    records, chroms = countRecords(infile, format)
+    chunk_size = max(1, -(-records // workers))
+
+    paths = []
+    files = []
+    counts = []
+    current = {}
+    runs = []
+    fh = bgzf.open_input(infile, buffering=ann.IO_BUFFER_SIZE)
+    for record in ann.readRecords(fh):
+        if ann.isHeader(record):
+            runs.append(record)
+            continue
+
+        chrom = record[chr_ind].strip()
+        shard = current.get(chrom)
+        if (shard is None or counts[shard] >= chunk_size):
+            if (shard is not None):
+                files[shard].close()
+            shard = len(paths)
+            paths.append(infile + '.shard' + str(shard))
+            files.append(open(paths[shard], 'w'))
+            counts.append(0)
+            current[chrom] = shard
+        ann.writeRecords([record], files[shard])
+        counts[shard] = counts[shard] + 1
+
+        if (len(runs) > 0 and not ann.isHeader(runs[-1]) and
+            runs[-1][0] == shard):
+            runs[-1][1] = runs[-1][1] + 1
+        else:
+            runs.append([shard, 1])
+    fh.close()
+
+    # Every run needs a shard, even an empty input, for the counters to be
+    # written
+    if (len(paths) == 0):
+        paths.append(infile + '.shard0')
+        files.append(open(paths[0], 'w'))
+    for fh_shard in files:
+        fh_shard.close()
+    return paths, runs
+
+
+# Connection pool of a worker process, see initWorker
+worker_pool = None
+
+def initWorker(connect=None, size=1):
+    global worker_pool
+    worker_pool = u.ConnectionPool(connect=connect, size=size)
+
+
+"""Runs the whole pipeline over the shard file path in a worker process,
+   into path.annot; the shard file is removed
+   The result caches of the pipeline are unpickled in the worker, which
+   opens their files; they are closed when the shard is done.
+   Returns the counters of the shard
+"""
+def runShard(path, format, pipeline):
+    conn = worker_pool.acquire()
+    log = ann.CountLog()
+    fh = open(path, buffering=ann.IO_BUFFER_SIZE)
+    fh_out = open(path + '.annot', 'w', buffering=ann.IO_BUFFER_SIZE)
+
+    try:
+        records = ann.readRecords(fh)
+        for message, stage, kwargs in pipeline:
+            records = stage(records, conn.cursor(), log, format=format,
+                **ann.stageKwargs(kwargs, worker_pool))
+        ann.writeRecords(records, fh_out)
+    finally:
+        fh.close()
+        fh_out.close()
+        for message, stage, kwargs in pipeline:
+            if (kwargs.get('cache') is not None):
+                kwargs['cache'].close()
+        worker_pool.release(conn)
+
+    fu.delete(path)
+    return log
+
+
+"""Annotates the shards of infile in worker processes and puts their
+   results back together in input order
+   Workers open their connections with connect (default: db_connect); it
+   has to be picklable where processes are spawned rather than forked.
+"""
+def runParallel(infile, format, pipeline, workers, compress=False,
+    connect=None):
+    paths, runs = splitShards(infile, format, workers)
+    log = ann.CountLog()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker,
+        initargs=(connect, poolSize(pipeline))) as executor:
+        futures = [executor.submit(runShard, path, format, pipeline)
+            for path in paths]
+        for future in futures:
+            log.merge(future.result())
+
+    for message, stage, kwargs in pipeline:
+        print(message + " - done.")
+
+    # A shard is opened when its first run comes and closed after its last
+    remaining = {}
+    for run in runs:
+        if not ann.isHeader(run):
+            remaining[run[0]] = remaining.get(run[0], 0) + run[1]
+    shards = {}
+    fh_out = bgzf.open_output(infile + '.annot', compress,
+        buffering=ann.IO_BUFFER_SIZE)
+    for run in runs:
+        if ann.isHeader(run):
+            fh_out.write(run + '\n')
+            continue
+        shard, count = run
+        if (shard not in shards):
+            shards[shard] = open(paths[shard] + '.annot')
+        for i in range(0, count):
+            fh_out.write(shards[shard].readline())
+        remaining[shard] = remaining[shard] - count
+        if (remaining[shard] == 0):
+            shards.pop(shard).close()
+    fh_out.close()
+
+    for path in paths:
+        fu.delete(path + '.annot')
+
+    fh_log = open(infile + '.count.log', 'w')
+    log.write(fh_log)
+    fh_log.close()
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,326 @@
+# index_audit.py
+#
+# Index audit and migration of the reference database
+#
+# Usage: python index_audit.py audit [options]
+#        python index_audit.py migration [options]
+#        python index_audit.py apply [--report <file>] [options]
+#
+#   audit - EXPLAIN of a representative query of every annotation stage:
+#           access type, index used and rows examined; full table scans
+#           are flagged
+#   migration - prints the statements creating the indexes in INDEXES
+#           that are missing; each one checks information_schema first,
+#           so the script can be run any number of times
+#   apply - times the queries, applies the migration and times them
+#           again; the per-stage latencies go to the report
+#
+# By default the database of the annotator (utils.db_connect) is audited;
+# --host, --port, --user and --password point the tool at a local MySQL
+# stand-in loaded with the same tables.
+#
+##
+
+import time
+import argparse
+import pymysql
+
+import utils as u
+from annotate import queryDbSnpBatch, queryBigRefGeneBatch
+from interval_index import open_index, SHARDS, BIN_COL, table_columns, \
+    row_order
+
+# Composite indexes the lookups need, per table; an existing index
+# starting with the same columns serves as well
+INDEXES = {
+    'dbSNP': [('CHR', 'POS')],
+    'chrom_pos_equal_base': [('CHR', 'start')],
+    'chrom_pos_equal_nobase': [('CHR', 'start')],
+    'chrom_pos_unequal': [('CHR', 'start', 'end')],
+    'refGene': [('chrom', 'bin'), ('chrom', 'txStart', 'txEnd')],
+    'cpgIslandExt': [('chrom', 'bin'), ('chrom', 'chromStart', 'chromEnd')],
+    'cytoBand': [('chrom', 'chromStart', 'chromEnd')],
+    'gadAll': [('chromosome', 'chromStart', 'chromEnd')],
+    'gwasCatalog': [('chrom', 'bin'), ('chrom', 'chromEnd')],
+    'targetScanS': [('chrom', 'bin'), ('chrom', 'chromStart', 'chromEnd')],
+    'hugo': [('chrom', 'bin'), ('chrom', 'chromStart', 'chromEnd')],
+    'dgv_Cnv': [('chrom', 'bin'), ('chrom', 'chromStart', 'chromEnd')],
+    'abParts_IG_T_CelReceptors': [('chrom', 'bin'),
+        ('chrom', 'chromStart', 'chromEnd')],
+    'mcCarroll_Cnv': [('chrom', 'bin'), ('chrom', 'chromStart', 'chromEnd')],
+    'conrad_Cnv': [('chrom', 'bin'), ('chrom', 'chromStart', 'chromEnd')],
+    'genomicSuperDups': [('chrom', 'bin'),
+        ('chrom', 'chromStart', 'chromEnd')],
+}
+# Every tfbsConsSites shard (tfbsConsSites1, ... tfbsConsSitesY)
+SHARD_INDEXES = [('bin',), ('chromStart', 'chromEnd')]
+
+# Column overrides of the region-overlap stages, as driver.stages opens them
+REGION_TABLES = [
+    ('BigRefGene', 'refGene', dict(start_col='txStart', end_col='txEnd')),
+    ('BigRefGene', 'cpgIslandExt', dict()),
+    ('Cytoband', 'cytoBand', dict()),
+    ('gadAll', 'gadAll', dict(chrom_col='chromosome')),
+    ('GwasCatalog', 'gwasCatalog',
+        dict(start_col='chromEnd', end_col='chromEnd')),
+    ('miRNA', 'targetScanS', dict()),
+    ('HUGO Gene Nomenclature Committee', 'hugo', dict()),
+    ('dgv_Cnv', 'dgv_Cnv', dict()),
+    ('abParts_IG_T_CelReceptors', 'abParts_IG_T_CelReceptors', dict()),
+    ('mcCarroll_Cnv', 'mcCarroll_Cnv', dict()),
+    ('conrad_Cnv', 'conrad_Cnv', dict()),
+    ('genomicSuperDups', 'genomicSuperDups', dict()),
+]
+
+# Variants of the representative dbSNP and BigRefGene batches, and the
+# bases between them
+BATCH_VARIANTS = 1000
+BATCH_STEP = 1000
+
+
+"""Stands in for a pymysql cursor and keeps the statements and their
+   parameters instead of running them; no statement returns rows
+   Given a cursor, the columns of every statement are looked up on it
+   (without reading any row) for callers reading cursor.description.
+"""
+class RecordingCursor(object):
+
+    def __init__(self, cursor=None):
+        self.cursor = cursor
+        self.statements = []
+        self.description = None
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, tuple(params)))
+        if (self.cursor is not None):
+            self.cursor.execute('select * from (' + sql.rstrip(' ;') +
+                ') as recorded limit 0;', params)
+            self.description = self.cursor.description
+            self.cursor.fetchall()
+
+    def fetchall(self):
+        return []
+
+    def fetchone(self):
+        return None
+
+
+"""The per-variant point query of a region-overlap stage and its parameters
+   The bin column and row order are looked up on cursor, as the stage
+   would, and only the query itself is recorded
+"""
+def point_sql(cursor, table, chrom, pos, sharded=False, **kwargs):
+    name = table + SHARDS[0] if sharded else table
+    if (BIN_COL in table_columns(cursor, name)):
+        kwargs['bin_col'] = BIN_COL
+    kwargs['order_by'] = row_order(cursor, name)
+    recording = RecordingCursor()
+    open_index(recording, table, 'point', sharded=sharded,
+        **kwargs).overlaps(chrom, pos)
+    return recording.statements[0]
+
+
+"""(table, sql, params) of the statements fetch, a batch query of
+   annotate, issues for variants; none returns rows, so every step of the
+   batch is issued
+"""
+def batch_sql(cursor, fetch, variants):
+    recording = RecordingCursor(cursor)
+    fetch(recording, variants)
+    return [(sql.split(' from ')[1].split()[0], sql, params)
+        for sql, params in recording.statements]
+
+
+"""(stage, table, sql, params) of a representative query of every stage
+   at chrom:pos; the dbSNP and BigRefGene ones are those of a batch of
+   batch variants BATCH_STEP bases apart from pos on, as the stages issue
+   them
+"""
+def stage_queries(cursor, chrom='1', pos=1000000, batch=BATCH_VARIANTS):
+    chrom = str(chrom).replace('chr', '')
+    positions = [str(int(pos) + i * BATCH_STEP) for i in range(0, batch)]
+    queries = [('dbSNP',) + statement for statement in batch_sql(cursor,
+        queryDbSnpBatch, [(chrom, p, 'A', 'T') for p in positions])]
+    queries.extend([('BigRefGene',) + statement for statement in batch_sql(
+        cursor, queryBigRefGeneBatch,
+        [(chrom, p, 'A', 'G', 'T', 'C') for p in positions])])
+    for stage, table, kwargs in REGION_TABLES:
+        queries.append((stage, table) +
+            point_sql(cursor, table, 'chr' + chrom, pos, **kwargs))
+    queries.append(('addOverlapWithTfbsConsSites', 'tfbsConsSites' + chrom) +
+        point_sql(cursor, 'tfbsConsSites', chrom, pos, sharded=True))
+    return queries
+
+
+def shard_tables():
+    return [('tfbsConsSites' + s, SHARD_INDEXES) for s in SHARDS]
+
+
+def rows_as_dicts(cursor):
+    names = [d[0] for d in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+
+"""EXPLAIN of sql with params; returns (access type, index, rows examined)
+   of its first table
+"""
+def explain(cursor, sql, params=()):
+    cursor.execute('explain ' + sql, params)
+    plan = rows_as_dicts(cursor)[0]
+    return str(plan.get('type')), str(plan.get('key')), \
+        int(plan.get('rows') or 0)
+
+
+"""Indexes of table as lists of column names, in index order
+"""
+def existing_indexes(cursor, table):
+    cursor.execute('select index_name, column_name from ' +
+        'information_schema.statistics where table_schema = database() ' +
+        'and table_name = %s order by index_name, seq_in_index;', (table,))
+    indexes = {}
+    for row in cursor.fetchall():
+        indexes.setdefault(row[0], []).append(str(row[1]).lower())
+    return list(indexes.values())
+
+
+def index_name(columns):
+    return 'ix_' + '_'.join(columns)
+
+
+"""(table, columns) of the wanted indexes no existing index covers
+"""
+def missing_indexes(cursor):
+    missing = []
+    for table, wanted in list(INDEXES.items()) + shard_tables():
+        have = existing_indexes(cursor, table)
+        for columns in wanted:
+            prefix = [c.lower() for c in columns]
+            if not any([index[:len(prefix)] == prefix for index in have]):
+                missing.append((table, columns))
+    return missing
+
+
+"""Statements creating one index unless an index of that name exists
+   MySQL has no "create index if not exists", so the check runs as a
+   prepared statement
+"""
+def create_index_statements(table, columns):
+    name = index_name(columns)
+    create = 'create index ' + name + ' on ' + table + ' (' + \
+        ', '.join(['`' + c + '`' for c in columns]) + ')'
+    return [
+        "set @ddl = (select if(count(*) = 0, '" + create + "', 'do 0') " +
+            "from information_schema.statistics where table_schema = " +
+            "database() and table_name = '" + table + "' and index_name = '" +
+            name + "');",
+        'prepare ddl from @ddl;',
+        'execute ddl;',
+        'deallocate prepare ddl;',
+    ]
+
+
+def migration(cursor):
+    statements = []
+    for table, columns in missing_indexes(cursor):
+        statements.append('-- ' + table + ' (' + ', '.join(columns) + ')')
+        statements.extend(create_index_statements(table, columns))
+    return statements
+
+
+"""Median seconds of sql with params over repeat runs
+"""
+def latency(cursor, sql, params=(), repeat=10):
+    times = []
+    for i in range(0, repeat):
+        start = time.time()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+"""Summed query latency of every stage, in stage order
+"""
+def stage_latencies(cursor, queries, repeat=10):
+    latencies = {}
+    for stage, table, sql, params in queries:
+        latencies[stage] = latencies.get(stage, 0) + \
+            latency(cursor, sql, params, repeat)
+    return latencies
+
+
+def audit(cursor, queries):
+    print('\t'.join(['stage', 'table', 'type', 'key', 'rows', 'scan']))
+    for stage, table, sql, params in queries:
+        access, key, rows = explain(cursor, sql, params)
+        print('\t'.join([stage, table, access, key, str(rows),
+            'FULL SCAN' if (access == 'ALL') else '']))
+
+
+def apply(conn, cursor, queries, report, repeat=10):
+    plans = [explain(cursor, sql, params)
+        for stage, table, sql, params in queries]
+    before = stage_latencies(cursor, queries, repeat)
+
+    statements = migration(cursor)
+    for sql in statements:
+        if not sql.startswith('--'):
+            cursor.execute(sql)
+    conn.commit()
+    print(f"Applied {len([s for s in statements if s.startswith('--')])} " +
+        "indexes")
+
+    after = stage_latencies(cursor, queries, repeat)
+    with open(report, 'w') as fh:
+        fh.write('\t'.join(['stage', 'table', 'type', 'key', 'rows',
+            'type_after', 'key_after', 'rows_after']) + '\n')
+        for (stage, table, sql, params), plan in zip(queries, plans):
+            fh.write('\t'.join([stage, table] + [str(x) for x in plan] +
+                [str(x) for x in explain(cursor, sql, params)]) + '\n')
+        fh.write('\n' + '\t'.join(['stage', 'ms_before', 'ms_after']) + '\n')
+        for stage in before:
+            fh.write('\t'.join([stage, f"{before[stage] * 1000:.2f}",
+                f"{after[stage] * 1000:.2f}"]) + '\n')
+    print(f"Report written to {report}")
+
+
+def connect(args):
+    if (args.host is None):
+        return u.db_connect()
+    return pymysql.connect(host=args.host, port=args.port, user=args.user,
+        passwd=args.password, db=args.database)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Index audit and migration of the reference database')
+    parser.add_argument('command', choices=['audit', 'migration', 'apply'])
+    parser.add_argument('--chrom', default='1',
+        help='chromosome of the representative queries')
+    parser.add_argument('--pos', type=int, default=1000000,
+        help='position of the representative queries')
+    parser.add_argument('--batch', type=int, default=BATCH_VARIANTS,
+        help='variants of the representative dbSNP and BigRefGene batches')
+    parser.add_argument('--repeat', type=int, default=10,
+        help='runs per query when timing')
+    parser.add_argument('--report', default='index_audit.report.tsv')
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--database', default='annotator')
+    args = parser.parse_args()
+
+    conn = connect(args)
+    cursor = conn.cursor()
+    queries = stage_queries(cursor, args.chrom, args.pos, args.batch)
+    if (args.command == 'audit'):
+        audit(cursor, queries)
+    elif (args.command == 'migration'):
+        print('\n'.join(migration(cursor)))
+    else:
+        apply(conn, cursor, queries, args.report, args.repeat)
+    conn.close()
+
+### EOF
\ No newline at end of file
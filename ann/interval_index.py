@@ -0,0 +1,830 @@
+# interval_index.py
+#
+# Lookup strategies for the region-overlap annotators
+#
+# Every strategy answers "which rows of <table> overlap position pos on
+# chromosome chrom" through the same overlaps()/first() interface:
+#   point - one query per lookup (the original behaviour)
+#   index - each chromosome is loaded once into an in-memory interval tree
+#   merge - sweep-line merge join for coordinate-sorted input
+#   window - one range query per window of nearby lookups
+#   snapshot - memory-mapped NumPy arrays exported by snapshot.py
+#
+##
+
+import heapq
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import utils as u
+import query as q
+
+# UCSC binning scheme (binRange.c of the Genome Browser): a row is filed in
+# the smallest bin holding all of it, from 128kb bins up to one 512Mb bin,
+# each level eight times coarser. The offsets run from the finest level.
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+# Rows ending past 512Mb use the extended scheme, one level more on top
+BIN_MAXEND_STANDARD = 1 << 29
+BIN_OFFSET_OLD_TO_EXTENDED = 4681
+BIN_EXTENDED_OFFSETS = [4096 + 512 + 64 + 8 + 1] + BIN_OFFSETS
+
+# Chromosome suffixes of the per-chromosome shard tables
+SHARDS = ['1','2','3','4','5','6','7','8','9','10','11','12','13','14','15',
+    '16','17','18','19','20','21','22','X','Y']
+
+# UCSC bin column of the reference tables that carry one (see
+# table_columns), indexed with chrom
+BIN_COL = 'bin'
+
+
+"""Bins that may hold rows overlapping the half-open range [start, end)
+"""
+def range_bins(start, end):
+    start = max(int(start), 0)
+    end = max(int(end), start + 1)
+    schemes = []
+    if (start < BIN_MAXEND_STANDARD):
+        schemes.append((BIN_OFFSETS, 0, min(end, BIN_MAXEND_STANDARD)))
+    if (end > BIN_MAXEND_STANDARD):
+        schemes.append((BIN_EXTENDED_OFFSETS, BIN_OFFSET_OLD_TO_EXTENDED,
+            end))
+
+    bins = []
+    for offsets, base, last in schemes:
+        shift = BIN_FIRST_SHIFT
+        for offset in offsets:
+            bins.extend(range(base + offset + (start >> shift),
+                base + offset + ((last - 1) >> shift) + 1))
+            shift = shift + BIN_NEXT_SHIFT
+    return bins
+
+
+"""SQL condition restricting bin_col to the bins of rows that can overlap
+   the closed range [lo, hi], and its parameters
+   The lookups compare coordinates inclusively on both ends while bins
+   are assigned on half-open ranges, hence the range grows by one base on
+   each side; the condition only prunes, the coordinate test still
+   decides.
+"""
+def bin_condition(bin_col, lo, hi):
+    placeholders, bins = q.in_list(range_bins(int(lo) - 1, int(hi) + 1))
+    return bin_col + ' in ' + placeholders, bins
+
+
+"""ORDER BY clause of a query, empty without order_by columns
+"""
+def order_clause(order_by):
+    return ' order by ' + order_by if order_by else ''
+
+
+"""Common interface of the lookup strategies
+   Lookups are (chrom, pos) tuples; overlaps_many and first_many resolve a
+   whole chunk of them, strategies override them when they can do better
+   than one lookup at a time.
+"""
+class LookupStrategy(object):
+
+    def overlaps(self, chrom, pos, end=None):
+        raise NotImplementedError
+
+    def first(self, chrom, pos, end=None):
+        rows = self.overlaps(chrom, pos, end)
+        if (len(rows) > 0):
+            return rows[0]
+        return None
+
+    def overlaps_many(self, lookups):
+        return [self.overlaps(chrom, pos) for chrom, pos in lookups]
+
+    def first_many(self, lookups):
+        return [self.first(chrom, pos) for chrom, pos in lookups]
+
+    """Releases what the strategy holds besides the stage cursor
+    """
+    def close(self):
+        pass
+
+"""maxends of the implicit augmented binary tree over ends, the ends of
+   intervals sorted by start (as in cgranges): the node at index i sits at
+   level k, where k is the number of trailing 1 bits of i, and maxends[i]
+   holds the largest end in the subtree rooted at i
+   Returns maxends and the level of the root.
+"""
+def tree_maxends(ends):
+    n = len(ends)
+    maxends = array('q', ends)
+    if (n == 0):
+        return maxends, -1
+
+    for i in range(0, n, 2):
+        last_i = i
+        last = ends[i]
+
+    k = 1
+    while ((1 << k) <= n):
+        x = 1 << (k - 1)
+        for i in range((x << 1) - 1, n, x << 2):
+            el = maxends[i - x]
+            er = maxends[i + x] if (i + x < n) else last
+            maxends[i] = max(ends[i], el, er)
+        last_i = last_i - x if ((last_i >> k) & 1) else last_i + x
+        if (last_i < n and maxends[last_i] > last):
+            last = maxends[last_i]
+        k = k + 1
+
+    return maxends, k - 1
+
+
+"""Indices (in start order) of the intervals overlapping [lo, hi], from
+   the tree tree_maxends built; any indexable arrays will do, e.g. the
+   memory-mapped ones of a snapshot
+"""
+def tree_overlaps(starts, ends, maxends, root_level, lo, hi):
+    n = len(starts)
+    if (n == 0):
+        return []
+
+    found = []
+    k = root_level
+    stack = [(k, (1 << k) - 1, False)]
+
+    while stack:
+        k, x, left_done = stack.pop()
+        if (k <= 3):
+            # Small subtree, scan it linearly
+            i0 = (x >> k) << k
+            i1 = min(i0 + (1 << (k + 1)) - 1, n)
+            for i in range(i0, i1):
+                if (starts[i] > hi):
+                    break
+                if (lo <= ends[i]):
+                    found.append(i)
+        elif not left_done:
+            y = x - (1 << (k - 1))
+            stack.append((k, x, True))
+            if (y >= n or maxends[y] >= lo):
+                stack.append((k - 1, y, False))
+        elif (x < n and starts[x] <= hi):
+            if (lo <= ends[x]):
+                found.append(x)
+            stack.append((k - 1, x + (1 << (k - 1)), False))
+
+    return found
+
+
+"""Intervals of a single chromosome
+
+Rows are sorted by start and laid out as an implicit augmented binary
+tree over the sorted arrays (see tree_maxends).
+Coordinates are closed, i.e. a row overlaps [lo, hi] when
+start <= hi and lo <= end, exactly as the per-variant SQL did.
+"""
+class ChromIntervals(object):
+
+    def __init__(self, intervals):
+        order = sorted(range(len(intervals)), key=lambda i: intervals[i][0])
+        self.starts = array('q', [intervals[i][0] for i in order])
+        self.ends = array('q', [intervals[i][1] for i in order])
+        self.rows = [intervals[i][2] for i in order]
+        # Position of each row in the original (table) order
+        self.ordinals = array('q', order)
+        self.maxends, self.root_level = tree_maxends(self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    """Rows overlapping [lo, hi], in the order the table returned them
+    """
+    def overlaps(self, lo, hi):
+        found = tree_overlaps(self.starts, self.ends, self.maxends,
+            self.root_level, lo, hi)
+        found.sort(key=self.ordinals.__getitem__)
+        return [self.rows[i] for i in found]
+
+
+"""Per-chromosome interval index over one reference table
+
+Replaces queries of the form
+    select * from <table> where <chrom_col>="<chr>"
+        AND <start_col> <= pos AND pos <= <end_col>
+The first lookup on a chromosome pulls all of its rows with a single
+query; every further lookup on that chromosome is answered in memory.
+"""
+class IntervalIndex(LookupStrategy):
+
+    def __init__(self, cursor, table, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', columns='*',
+        order_by=None):
+        self.cursor = cursor
+        self.table = table
+        self.chrom_col = chrom_col
+        self.start_col = start_col
+        self.end_col = end_col
+        self.columns = columns
+        self.order_by = order_by
+        self.chroms = {}
+
+    def _sql(self, chrom):
+        return 'select ' + self.columns + ' from ' + self.table + \
+            ' where ' + self.chrom_col + ' = ?' + \
+            order_clause(self.order_by) + ';', (str(chrom),)
+
+    def _load(self, chrom):
+        q.execute(self.cursor, *self._sql(chrom))
+        names = [d[0] for d in self.cursor.description]
+        start_ind = names.index(self.start_col)
+        end_ind = names.index(self.end_col)
+        rows = self.cursor.fetchall()
+        return ChromIntervals(
+            [(int(row[start_ind]), int(row[end_ind]), row) for row in rows])
+
+    def chrom(self, chrom):
+        intervals = self.chroms.get(chrom)
+        if (intervals is None):
+            intervals = self._load(chrom)
+            self.chroms[chrom] = intervals
+        return intervals
+
+    """All rows overlapping pos (or [pos, end]), in table order
+    """
+    def overlaps(self, chrom, pos, end=None):
+        pos = int(pos)
+        end = pos if (end is None) else int(end)
+        return self.chrom(chrom).overlaps(pos, end)
+
+
+"""One query per lookup
+   With bin_col set, the query is narrowed to the UCSC bins that can hold
+   an overlapping row, so the (chrom, bin) index is used instead of a
+   scan over the chromosome. With order_by set (see row_order), rows come
+   back in that order, and first() is the first of them.
+"""
+class PointQuery(LookupStrategy):
+
+    def __init__(self, cursor, table, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', columns='*',
+        bin_col=None, order_by=None):
+        self.cursor = cursor
+        self.table = table
+        self.chrom_col = chrom_col
+        self.start_col = start_col
+        self.end_col = end_col
+        self.columns = columns
+        self.bin_col = bin_col
+        self.order_by = order_by
+
+    def _query(self, chrom, pos, end):
+        sql = 'select ' + self.columns + ' from ' + self.table + \
+            ' where ' + self.chrom_col + ' = ? AND '
+        params = [str(chrom)]
+        if (self.bin_col is not None):
+            condition, bins = bin_condition(self.bin_col, pos, end)
+            sql = sql + condition + ' AND '
+            params.extend(bins)
+        sql = sql + '(' + self.start_col + ' <= ? AND ? <= ' + \
+            self.end_col + ')' + order_clause(self.order_by) + ';'
+        q.execute(self.cursor, sql, params + [int(end), int(pos)])
+
+    def overlaps(self, chrom, pos, end=None):
+        self._query(chrom, pos, pos if (end is None) else end)
+        return list(self.cursor.fetchall())
+
+    def first(self, chrom, pos, end=None):
+        self._query(chrom, pos, pos if (end is None) else end)
+        return self.cursor.fetchone()
+
+
+"""One range query per window of lookups
+
+A chunk of lookups is split by chromosome and sorted by position; runs
+of up to window_size consecutive positions, none more than max_gap bases
+after the previous one, form a window. Each window is fetched with one
+    select * from <table> where <chrom_col>="<chr>"
+        AND <end_col> >= min_pos AND <start_col> <= max_pos
+and its lookups are resolved in memory against those rows, which are
+dropped once the window is done. Memory follows the window, not the
+table, and dense regions take one round trip per window_size variants.
+"""
+class WindowQuery(LookupStrategy):
+
+    def __init__(self, cursor, table, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', columns='*',
+        window_size=1000, max_gap=1000000, order_by=None):
+        self.cursor = cursor
+        self.table = table
+        self.chrom_col = chrom_col
+        self.start_col = start_col
+        self.end_col = end_col
+        self.columns = columns
+        self.window_size = window_size
+        self.max_gap = max_gap
+        self.order_by = order_by
+
+    def _sql(self, chrom, lo, hi):
+        return 'select ' + self.columns + ' from ' + self.table + \
+            ' where ' + self.chrom_col + ' = ? AND ' + self.end_col + \
+            ' >= ? AND ' + self.start_col + ' <= ?' + \
+            order_clause(self.order_by) + ';', (str(chrom), int(lo), int(hi))
+
+    def _fetch(self, chrom, lo, hi):
+        q.execute(self.cursor, *self._sql(chrom, lo, hi))
+        names = [d[0] for d in self.cursor.description]
+        start_ind = names.index(self.start_col)
+        end_ind = names.index(self.end_col)
+        return ChromIntervals([(int(row[start_ind]), int(row[end_ind]), row)
+            for row in self.cursor.fetchall()])
+
+    """Lists of lookup indices, one per window
+    """
+    def _windows(self, ranges, slots):
+        slots = sorted(slots, key=lambda i: ranges[i][0])
+        windows = []
+        window = []
+        for i in slots:
+            if (len(window) > 0 and (len(window) >= self.window_size or
+                ranges[i][0] - ranges[window[-1]][0] > self.max_gap)):
+                windows.append(window)
+                window = []
+            window.append(i)
+        if (len(window) > 0):
+            windows.append(window)
+        return windows
+
+    """lookups are (chrom, pos) or (chrom, pos, end) tuples
+    """
+    def overlaps_many(self, lookups):
+        results = [None] * len(lookups)
+        ranges = [(int(lookup[1]), int(lookup[-1])) for lookup in lookups]
+        by_chrom = {}
+        for i, lookup in enumerate(lookups):
+            by_chrom.setdefault(lookup[0], []).append(i)
+
+        for chrom, slots in by_chrom.items():
+            for window in self._windows(ranges, slots):
+                intervals = self._fetch(chrom, ranges[window[0]][0],
+                    max([ranges[i][1] for i in window]))
+                for i in window:
+                    results[i] = intervals.overlaps(*ranges[i])
+
+        return results
+
+    def first_many(self, lookups):
+        return [rows[0] if (len(rows) > 0) else None
+            for rows in self.overlaps_many(lookups)]
+
+    def overlaps(self, chrom, pos, end=None):
+        lookup = (chrom, pos) if (end is None) else (chrom, pos, end)
+        return self.overlaps_many([lookup])[0]
+
+
+"""Sweep-line merge join of coordinate-sorted lookups against a table
+
+Each chromosome is streamed ordered by start, fetch_size rows at a time
+(keyset pagination on the start column), next to the VCF. Rows enter a
+heap keyed by end once the sweep reaches their start and leave it once
+it passes their end, so only the intervals active at the current position
+are kept in memory. Every row is fetched with its key in table order (see
+row_order) and overlapping rows are reported in that order, as the other
+strategies report them; a table without such a key is not swept, all its
+lookups go to the fallback.
+
+Lookups must arrive sorted by position within a chromosome and each
+chromosome must appear in a single run. As soon as a lookup breaks that
+order, the remaining lookups are answered by the fallback strategy.
+"""
+class SweepIndex(LookupStrategy):
+
+    def __init__(self, cursor, table, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', columns='*',
+        fetch_size=10000, fallback=None):
+        self.cursor = cursor
+        self.table = table
+        self.chrom_col = chrom_col
+        self.start_col = start_col
+        self.end_col = end_col
+        self.columns = columns
+        self.fetch_size = fetch_size
+        if (fallback is None):
+            fallback = IntervalIndex(cursor, table, chrom_col=chrom_col,
+                start_col=start_col, end_col=end_col, columns=columns)
+        self.fallback = fallback
+        self.order_by = row_order(cursor, table)
+        self.sorted = (self.order_by is not None)
+        self.done_chroms = set([])
+        self.chrom = None
+        self.pos = None
+
+    def _start_chrom(self, chrom):
+        if (self.chrom is not None):
+            self.done_chroms.add(self.chrom)
+        self.chrom = chrom
+        self.pos = None
+        self.active = []
+        self.pending = []
+        self.next_start = None
+        self.exhausted = False
+        self.seq = 0
+
+    """Fetches the next page of rows (ordered by start) into pending, as
+       (start, end, key in table order, row)
+    """
+    def _fetch(self):
+        sql = 'select ' + self.columns + ', ' + self.order_by + ' from ' + \
+            self.table + ' where ' + self.chrom_col + ' = ?'
+        params = [str(self.chrom)]
+        if (self.next_start is not None):
+            sql = sql + ' AND ' + self.start_col + ' >= ?'
+            params.append(int(self.next_start))
+        sql = sql + ' order by ' + self.start_col + ' limit ?;'
+        q.execute(self.cursor, sql, params + [int(self.fetch_size)])
+        names = [d[0] for d in self.cursor.description]
+        start_ind = names.index(self.start_col)
+        end_ind = names.index(self.end_col)
+        # The key columns come last, after those of the row
+        keys = len(self.order_by.split(','))
+        rows = [(int(row[start_ind]), int(row[end_ind]), tuple(row[-keys:]),
+            tuple(row[:-keys])) for row in self.cursor.fetchall()]
+
+        if (len(rows) < self.fetch_size):
+            self.exhausted = True
+        else:
+            # The next page starts at the last start seen; drop the rows
+            # sharing that start here, they will come again with it
+            last = rows[-1][0]
+            kept = [r for r in rows if r[0] < last]
+            if (len(kept) == 0):
+                # A single start fills the page, read it as a whole
+                self.fetch_size = self.fetch_size * 2
+                return
+            rows = kept
+            self.next_start = last
+
+        self.pending.extend(rows)
+        self.pending.reverse()
+
+    def _advance(self, pos):
+        while True:
+            while (len(self.pending) > 0 and self.pending[-1][0] <= pos):
+                start, end, key, row = self.pending.pop()
+                heapq.heappush(self.active, (end, self.seq, key, row))
+                self.seq = self.seq + 1
+            if (len(self.pending) > 0 or self.exhausted):
+                break
+            self._fetch()
+
+        while (len(self.active) > 0 and self.active[0][0] < pos):
+            heapq.heappop(self.active)
+
+    def overlaps(self, chrom, pos, end=None):
+        if (not self.sorted or end is not None):
+            return self.fallback.overlaps(chrom, pos, end)
+
+        pos = int(pos)
+        if (chrom != self.chrom):
+            if (chrom in self.done_chroms):
+                self.sorted = False
+            else:
+                self._start_chrom(chrom)
+        elif (self.pos is not None and pos < self.pos):
+            self.sorted = False
+
+        if not self.sorted:
+            # Input is not coordinate-sorted, stop sweeping
+            self.active = []
+            self.pending = []
+            return self.fallback.overlaps(chrom, pos)
+
+        self.pos = pos
+        self._advance(pos)
+        return [row for end, seq, key, row in sorted(self.active,
+            key=lambda a: a[2])]
+
+
+"""One query per lookup against per-chromosome shard tables
+   (<table>1, <table>2, ... <table>X); chrom is the shard suffix and the
+   shard tables have no chromosome condition
+"""
+class ShardPointQuery(LookupStrategy):
+
+    def __init__(self, cursor, table, start_col='chromStart',
+        end_col='chromEnd', columns='*', bin_col=None, order_by=None):
+        self.cursor = cursor
+        self.table = table
+        self.start_col = start_col
+        self.end_col = end_col
+        self.columns = columns
+        self.bin_col = bin_col
+        self.order_by = order_by
+
+    def overlaps(self, chrom, pos, end=None):
+        end = pos if (end is None) else end
+        sql = 'select ' + self.columns + ' from ' + self.table + \
+            str(chrom) + ' where  '
+        params = []
+        if (self.bin_col is not None):
+            condition, params = bin_condition(self.bin_col, pos, end)
+            sql = sql + condition + ' AND '
+        sql = sql + self.start_col + ' <= ? AND ? <= ' + self.end_col + \
+            order_clause(self.order_by) + ';'
+        q.execute(self.cursor, sql, params + [int(end), int(pos)])
+        return list(self.cursor.fetchall())
+
+
+"""Window-batched range queries against per-chromosome shard tables
+"""
+class ShardWindowQuery(WindowQuery):
+
+    def __init__(self, cursor, table, start_col='chromStart',
+        end_col='chromEnd', columns='*', window_size=1000, max_gap=1000000,
+        order_by=None):
+        WindowQuery.__init__(self, cursor, table, start_col=start_col,
+            end_col=end_col, columns=columns, window_size=window_size,
+            max_gap=max_gap, order_by=order_by)
+
+    def _sql(self, chrom, lo, hi):
+        return 'select ' + self.columns + ' from ' + self.table + \
+            str(chrom) + ' where ' + self.end_col + ' >= ? AND ' + \
+            self.start_col + ' <= ?' + order_clause(self.order_by) + ';', \
+            (int(lo), int(hi))
+
+
+"""Interval index over per-chromosome shard tables (<table>1, ... <table>Y)
+
+A shard is loaded the first time its chromosome is looked up. Loaded
+shards are kept up to max_rows rows in total; past that the least
+recently used ones are dropped, to be loaded again if they come back, so
+a VCF spanning every chromosome does not hold every shard at once.
+"""
+class ShardIndex(IntervalIndex):
+
+    def __init__(self, cursor, table, start_col='chromStart',
+        end_col='chromEnd', columns='*', max_rows=5000000, order_by=None):
+        IntervalIndex.__init__(self, cursor, table, start_col=start_col,
+            end_col=end_col, columns=columns, order_by=order_by)
+        self.max_rows = max_rows
+        self.chroms = OrderedDict()
+        self.loaded_rows = 0
+
+    def _sql(self, chrom):
+        return 'select ' + self.columns + ' from ' + self.table + \
+            str(chrom) + order_clause(self.order_by) + ';', ()
+
+    def chrom(self, chrom):
+        intervals = self.chroms.get(chrom)
+        if (intervals is not None):
+            self.chroms.move_to_end(chrom)
+            return intervals
+
+        intervals = self._load(chrom)
+        self.chroms[chrom] = intervals
+        self.loaded_rows = self.loaded_rows + len(intervals)
+        while (self.loaded_rows > self.max_rows and len(self.chroms) > 1):
+            evicted, evicted_intervals = self.chroms.popitem(last=False)
+            self.loaded_rows = self.loaded_rows - len(evicted_intervals)
+        return intervals
+
+
+"""Remembers the answers of index per position, for lookups repeated
+   at the same positions; forgets them all once size are held
+"""
+class MemoizedLookup(LookupStrategy):
+
+    def __init__(self, index, size=100000):
+        self.index = index
+        self.size = size
+        self.memo = {}
+
+    def _remember(self, key, value):
+        if (len(self.memo) >= self.size):
+            self.memo.clear()
+        self.memo[key] = value
+        return value
+
+    def overlaps(self, chrom, pos, end=None):
+        key = ('overlaps', chrom, int(pos), end)
+        if (key in self.memo):
+            return self.memo[key]
+        return self._remember(key, self.index.overlaps(chrom, pos, end))
+
+    def first(self, chrom, pos, end=None):
+        key = ('first', chrom, int(pos), end)
+        if (key in self.memo):
+            return self.memo[key]
+        return self._remember(key, self.index.first(chrom, pos, end))
+
+    def close(self):
+        self.index.close()
+
+
+"""Keeps up to concurrency queries in flight
+
+Each chunk of lookups is cut into concurrency contiguous slices, which are
+resolved in parallel threads, every one on its own connection of pool
+(a utils.ConnectionPool, the run's) through a strategy make_index(cursor)
+opens on it. Without a pool, one of concurrency connections is opened and
+closed with the lookup. The results are put back together in lookup order.
+"""
+class ConcurrentLookup(LookupStrategy):
+
+    def __init__(self, make_index, concurrency, pool=None):
+        self.make_index = make_index
+        self.concurrency = concurrency
+        self.own_pool = (pool is None)
+        self.pool = u.ConnectionPool(size=concurrency) if self.own_pool \
+            else pool
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def _resolve(self, part, first):
+        conn = self.pool.acquire()
+        try:
+            index = self.make_index(conn.cursor())
+            if first:
+                return index.first_many(part)
+            return index.overlaps_many(part)
+        finally:
+            self.pool.release(conn)
+
+    def _many(self, lookups, first):
+        size = max(1, -(-len(lookups) // self.concurrency))
+        parts = [lookups[i:i + size] for i in range(0, len(lookups), size)]
+        results = []
+        for found in self.executor.map(
+            lambda part: self._resolve(part, first), parts):
+            results.extend(found)
+        return results
+
+    def overlaps(self, chrom, pos, end=None):
+        lookup = (chrom, pos) if (end is None) else (chrom, pos, end)
+        return self._resolve([lookup], False)[0]
+
+    def overlaps_many(self, lookups):
+        return self._many(lookups, False)
+
+    def first_many(self, lookups):
+        return self._many(lookups, True)
+
+    def close(self):
+        self.executor.shutdown()
+        if self.own_pool:
+            self.pool.close()
+
+
+"""Rows of table (all its shards if sharded); the estimate of
+   information_schema where there is one, cached per process
+"""
+_table_rows = {}
+
+def table_rows(cursor, table, sharded=False):
+    if (table not in _table_rows):
+        total = 0
+        for name in ([table + s for s in SHARDS] if sharded else [table]):
+            try:
+                q.execute(cursor, 'select table_rows from ' +
+                    'information_schema.tables where table_schema = ' +
+                    'database() and table_name = ?;', (name,))
+                row = cursor.fetchone()
+            except Exception:
+                # No information_schema, e.g. SQLite
+                row = None
+            if (row is None or row[0] is None):
+                cursor.execute('select count(*) from ' + name + ';')
+                row = cursor.fetchone()
+            total = total + int(row[0])
+        _table_rows[table] = total
+    return _table_rows[table]
+
+
+"""Lower-cased column names of table, from the description of an empty
+   select; cached per process
+"""
+_table_columns = {}
+
+def table_columns(cursor, table):
+    if (table not in _table_columns):
+        cursor.execute('select * from ' + table + ' limit 0;')
+        _table_columns[table] = set([str(d[0]).lower()
+            for d in cursor.description])
+        cursor.fetchall()
+    return _table_columns[table]
+
+
+"""Columns ordering the rows of table as stored, for an ORDER BY: its
+   primary key, or the rowid of SQLite; None if it has neither. Cached
+   per process.
+"""
+_row_orders = {}
+
+def row_order(cursor, table):
+    if (table not in _row_orders):
+        order = None
+        try:
+            q.execute(cursor, 'select column_name from ' +
+                'information_schema.key_column_usage where table_schema = ' +
+                'database() and table_name = ? and constraint_name = ? ' +
+                'order by ordinal_position;', (table, 'PRIMARY'))
+            order = ', '.join([str(row[0]) for row in cursor.fetchall()])
+        except Exception:
+            # No information_schema, e.g. SQLite
+            try:
+                cursor.execute('select rowid from ' + table + ' limit 0;')
+                cursor.fetchall()
+                order = 'rowid'
+            except Exception:
+                order = None
+        _row_orders[table] = order or None
+    return _row_orders[table]
+
+
+# Cost model of strategy='auto', in rows: a round trip to the database
+# costs as much as transferring and indexing QUERY_COST rows
+QUERY_COST = 200
+GENOME_SIZE = 3100000000
+
+"""Estimated cost of looking up records variants on chroms chromosomes
+   in a table of rows rows, per strategy
+   point pays a round trip per variant; index loads every touched
+   chromosome whole; window pays a round trip per window and the rows
+   within max_gap of the variants, at most the touched chromosomes.
+"""
+def strategy_costs(records, chroms, rows, window_size=1000,
+    max_gap=1000000):
+    touched = rows * min(chroms, len(SHARDS)) // len(SHARDS)
+    nearby = rows * records * max_gap // GENOME_SIZE
+    return dict(
+        point=records * QUERY_COST,
+        window=(-(-records // window_size) + chroms) * QUERY_COST +
+            min(touched, nearby),
+        index=chroms * QUERY_COST + touched)
+
+
+"""Cheapest of strategies for table, given the size of the input
+   Returns the strategy, the table rows and the estimated costs
+"""
+def choose_strategy(cursor, table, records, chroms, sharded=False,
+    strategies=('point', 'window', 'index')):
+    rows = table_rows(cursor, table, sharded)
+    costs = strategy_costs(records, chroms, rows)
+    costs = dict([(s, costs[s]) for s in strategies])
+    return min(strategies, key=lambda s: costs[s]), rows, costs
+
+
+STRATEGIES = {
+    'point': PointQuery,
+    'index': IntervalIndex,
+    'merge': SweepIndex,
+    'window': WindowQuery,
+}
+
+SHARDED_STRATEGIES = {
+    'point': ShardPointQuery,
+    'index': ShardIndex,
+    'window': ShardWindowQuery,
+}
+
+
+"""Lookup strategy for table by name, see STRATEGIES
+   sharded tables are split into one physical table per chromosome.
+   snapshot_dir is the directory written by snapshot.py, required by the
+   'snapshot' strategy. Lookups go through cache (a
+   result_cache.ResultCache) first if one is given. Point queries against
+   tables with a BIN_COL column are narrowed by it, and the point, index
+   and window queries report rows in table order (see row_order) unless
+   bin_col or order_by are given. Sharded tables are probed through their
+   first shard.
+   Point and window lookups keep up to concurrency queries in flight, on
+   connections of pool (see ConcurrentLookup); the stage has to close()
+   the index then.
+"""
+def open_index(cursor, table, strategy='index', sharded=False,
+    snapshot_dir=None, cache=None, concurrency=1, pool=None, **kwargs):
+
+    if (strategy == 'snapshot'):
+        # Needs NumPy, only imported when snapshots are used
+        import snapshot
+        index = snapshot.SnapshotIndex(snapshot_dir, table, **kwargs)
+    else:
+        strategies = SHARDED_STRATEGIES if sharded else STRATEGIES
+        if (strategy not in strategies):
+            raise ValueError(
+                f"Unknown lookup strategy '{strategy}' for {table}")
+        name = table + SHARDS[0] if sharded else table
+        if (strategy == 'point' and 'bin_col' not in kwargs and
+            BIN_COL in table_columns(cursor, name)):
+            kwargs['bin_col'] = BIN_COL
+        if (strategy != 'merge' and 'order_by' not in kwargs):
+            kwargs['order_by'] = row_order(cursor, name)
+        if (concurrency > 1 and strategy in ('point', 'window')):
+            index = ConcurrentLookup(lambda cursor: strategies[strategy](
+                cursor, table, **kwargs), concurrency, pool)
+        else:
+            index = strategies[strategy](cursor, table, **kwargs)
+
+    if (cache is not None):
+        index = cache.wrap(index, table,
+            strategy + repr(sorted(kwargs.items())))
+    return index
+
+### EOF
@@ -17,6 +17,7 @@ import file_utils as fu
 HETERO = {'M':'AC', 'R':'AG', 'W':'AT', 'S':'CG', 'Y':'CT', 'K':'GT'}
 ACCEPTED_CHR = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", 
                 "14", "15", "16", "17", "18", "19", "20","21","22", "X", "Y", "MT"]
+ACCEPTED_CHR_SET = frozenset(ACCEPTED_CHR)
 #http://www.broadinstitute.org/gsa/wiki/index.php/Understanding_the_Unified_Genotyper's_VCF_files
 
 def count_alt(depth, bases):
@@ -58,7 +59,7 @@ def vcfheader(pileup):
 
 def hetero2homo(ref, alt):
     """ Converts heterozygous symbols from Samtools pileup to A, G, T, C """
-    if not fu.isOnTheList(HETERO.keys(), alt):
+    if str(alt) not in HETERO:
         return alt
     else:
         alt_x = HETERO[alt]
@@ -83,7 +84,7 @@ def varpileup_line2vcf_line(pileupfields):
     alt_count = str(count_alt(depth, pileupfields[8]))
 
     GT = '1/1'
-    if fu.isOnTheList(HETERO.keys(), alt):
+    if alt in HETERO:
         GT = '0/1'
         alt = hetero2homo(ref,alt)
 
@@ -113,7 +114,7 @@ def filter_pileup(pileup, outfile=None, chr_col=0,
         alt = str(fields[alt_col])
 
         if ((alt != ref) and \
-            (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
+            (chr.strip() in ACCEPTED_CHR_SET)):
             fh_out.write(varpileup_line2vcf_line(fields[0:9]) + '\n' )
 
 
@@ -142,7 +143,7 @@ def filter_vcf(pileup, outfile=None,  chr_col=0, ref_col=3,
                 alt = str(fields[alt_col])
 
                 if ((alt != ref) and \
-                    (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
+                    (chr.strip() in ACCEPTED_CHR_SET)):
                     fh_out.write(str(line) + '\n')
 
 ### EOF
\ No newline at end of file
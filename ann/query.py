@@ -0,0 +1,116 @@
+# query.py
+#
+# Parameterized queries for the annotator
+#
+# Queries are written with ? placeholders and run with bound parameters:
+# the values are escaped by the driver instead of pasted into the SQL, and
+# the SQL text stays the same from one record to the next. This is
+# parameterization only, nothing is prepared on the server. pymysql
+# substitutes the parameters on the client and sends a full text query on
+# every execute, which MySQL parses and plans each time; there is no parse
+# or plan saving.
+#
+# The placeholders of each distinct text are translated to the paramstyle
+# of the cursor once, and the translation is kept per cursor (text
+# deduplication). The counters tell the distinct texts from the
+# executions, nothing more.
+#
+# IN lists are padded to a power of two (repeating their last value), so
+# batches of different sizes share a handful of texts.
+#
+##
+
+import sys
+import threading
+import weakref
+
+# Translated texts kept per cursor
+MAX_TEXTS = 256
+
+_texts = weakref.WeakKeyDictionary()
+_stats = dict(distinct_texts=0, executed=0)
+_lock = threading.Lock()
+
+
+def _count(key):
+    with _lock:
+        _stats[key] = _stats[key] + 1
+
+
+"""Placeholder of the DB-API module of cursor: ? for sqlite3, %s for
+   pymysql and the other format/pyformat drivers
+"""
+def placeholder(cursor):
+    module = sys.modules.get(type(cursor).__module__.split('.')[0])
+    if (getattr(module, 'paramstyle', None) == 'qmark'):
+        return '?'
+    return '%s'
+
+
+"""sql with its placeholders translated for cursor
+"""
+class ParameterizedQuery(object):
+
+    def __init__(self, cursor, sql):
+        self.cursor = cursor
+        if (placeholder(cursor) != '?'):
+            sql = sql.replace('%', '%%').replace('?', '%s')
+        self.sql = sql
+
+    def execute(self, params=()):
+        self.cursor.execute(self.sql, tuple(params))
+        _count('executed')
+        return self.cursor
+
+
+"""The ParameterizedQuery of sql on cursor, translated on first use
+"""
+def parameterized(cursor, sql):
+    with _lock:
+        texts = _texts.get(cursor)
+        if (texts is None):
+            texts = {}
+            _texts[cursor] = texts
+        query = texts.get(sql)
+        if (query is None):
+            if (len(texts) >= MAX_TEXTS):
+                texts.clear()
+            query = ParameterizedQuery(cursor, sql)
+            texts[sql] = query
+            _stats['distinct_texts'] = _stats['distinct_texts'] + 1
+    return query
+
+
+"""Runs sql with params on cursor and returns the cursor
+"""
+def execute(cursor, sql, params=()):
+    return parameterized(cursor, sql).execute(params)
+
+
+"""Placeholders and parameters of an IN list of values
+   The list is padded to the next power of two with its last value, which
+   leaves the condition unchanged
+"""
+def in_list(values):
+    values = list(values)
+    size = 1
+    while (size < len(values)):
+        size = size * 2
+    values = values + values[-1:] * (size - len(values))
+    return '(' + ','.join(['?'] * len(values)) + ')', values
+
+
+"""Distinct SQL texts (per cursor) and queries executed so far, in this
+   process
+"""
+def counts():
+    with _lock:
+        return dict(_stats)
+
+
+def reset_counts():
+    with _lock:
+        for key in _stats:
+            _stats[key] = 0
+
+### EOF
\ No newline at end of file
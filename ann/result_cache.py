@@ -0,0 +1,217 @@
+# result_cache.py
+#
+# Cross-job cache of per-variant annotation results
+#
+# Results are keyed by (stage, chrom, pos, ref, alt, reference_version),
+# the stage qualified by the lookup strategy that produced them, and are
+# kept in two tiers: an in-process LRU of memory_size entries and an SQLite
+# file shared by every job on the host, bounded to disk_size entries. Both
+# evict the least recently used entries first. Bump reference_version
+# whenever the reference tables are reloaded. The threads of a stage can
+# share a cache; fetches run outside its lock.
+#
+##
+
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from interval_index import LookupStrategy
+
+# Keys per "where key in (...)" query, below SQLite's parameter limit
+DISK_BATCH_SIZE = 500
+
+_MISSING = object()
+
+
+class ResultCache(object):
+
+    def __init__(self, path, reference_version, memory_size=100000,
+        disk_size=5000000):
+        self.path = path
+        self.reference_version = reference_version
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory = OrderedDict()
+        self.stats = {}
+        self.db = None
+        self.disk_count = 0
+        self.lock = threading.RLock()
+
+    # Worker processes get the settings only and open the file themselves
+    def __getstate__(self):
+        return dict(path=self.path, reference_version=self.reference_version,
+            memory_size=self.memory_size, disk_size=self.disk_size)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connect(self):
+        if (self.db is None):
+            directory = os.path.dirname(self.path)
+            if (directory != ''):
+                os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=60,
+                check_same_thread=False)
+            self.db.execute('pragma journal_mode=wal;')
+            self.db.execute('create table if not exists results ' +
+                '(key text primary key, value blob, used real);')
+            self.db.execute('create index if not exists results_used ' +
+                'on results (used);')
+            self.db.commit()
+            self.disk_count = self.db.execute(
+                'select count(*) from results;').fetchone()[0]
+        return self.db
+
+    def key(self, stage, chrom, pos, ref='', alt=''):
+        return '\t'.join([str(stage), str(chrom), str(int(pos)), str(ref),
+            str(alt), str(self.reference_version)])
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if (len(self.memory) > self.memory_size):
+            self.memory.popitem(last=False)
+
+    def _read(self, keys):
+        db = self._connect()
+        found = {}
+        for i in range(0, len(keys), DISK_BATCH_SIZE):
+            batch = keys[i:i + DISK_BATCH_SIZE]
+            sql = 'select key, value from results where key in (' + \
+                ','.join(['?'] * len(batch)) + ');'
+            for key, value in db.execute(sql, batch):
+                found[key] = pickle.loads(value)
+
+        if (len(found) > 0):
+            now = time.time()
+            db.executemany('update results set used = ? where key = ?;',
+                [(now, key) for key in found])
+            db.commit()
+        return found
+
+    def _write(self, items):
+        db = self._connect()
+        now = time.time()
+        db.executemany('insert or replace into results values (?, ?, ?);',
+            [(key, pickle.dumps(value), now) for key, value in items])
+        self.disk_count = self.disk_count + len(items)
+
+        if (self.disk_count > self.disk_size):
+            self.disk_count = db.execute(
+                'select count(*) from results;').fetchone()[0]
+            excess = self.disk_count - self.disk_size
+            if (excess > 0):
+                # Evict a tenth more, not to do this again on the next write
+                excess = excess + self.disk_size // 10
+                db.execute('delete from results where key in (select key ' +
+                    'from results order by used limit ?);', (excess,))
+                self.disk_count = self.disk_count - excess
+        db.commit()
+
+    """Cached results of stage for keys, a list of (chrom, pos, ref, alt)
+       fetch is called once with the indices of the keys found in neither
+       tier and returns their results, in the same order. Results of
+       lookups configured differently (variant) are kept apart but counted
+       under the same stage.
+    """
+    def resolve(self, stage, keys, fetch, variant=''):
+        key_stage = stage + '/' + variant if variant else stage
+        cache_keys = [self.key(key_stage, *k) for k in keys]
+        results = [_MISSING] * len(keys)
+
+        with self.lock:
+            for i, key in enumerate(cache_keys):
+                value = self.memory.get(key, _MISSING)
+                if (value is not _MISSING):
+                    self.memory.move_to_end(key)
+                    results[i] = value
+
+            missing = [i for i, value in enumerate(results)
+                if value is _MISSING]
+            if (len(missing) > 0):
+                found = self._read([cache_keys[i] for i in missing])
+                for i in missing:
+                    value = found.get(cache_keys[i], _MISSING)
+                    if (value is not _MISSING):
+                        self._remember(cache_keys[i], value)
+                        results[i] = value
+
+            missing = [i for i, value in enumerate(results)
+                if value is _MISSING]
+            stats = self.stats.setdefault(stage, [0, 0])
+            stats[0] = stats[0] + len(keys) - len(missing)
+            stats[1] = stats[1] + len(keys)
+
+        if (len(missing) > 0):
+            fetched = fetch(missing)
+            with self.lock:
+                for i, value in zip(missing, fetched):
+                    self._remember(cache_keys[i], value)
+                    results[i] = value
+                self._write([(cache_keys[i], results[i]) for i in missing])
+
+        return results
+
+    def counts(self, stage):
+        hits, lookups = self.stats.get(stage, [0, 0])
+        return dict(hits=hits, lookups=lookups)
+
+    """Lookup strategy answering from the cache before asking index
+       variant tells apart lookups of stage through other strategies or
+       columns, see CachedLookup
+    """
+    def wrap(self, index, stage, variant=''):
+        return CachedLookup(index, self, stage, variant)
+
+    def close(self):
+        with self.lock:
+            if (self.db is not None):
+                self.db.close()
+                self.db = None
+
+
+"""Region-overlap lookups through a ResultCache
+   Overlaps do not depend on the alleles, so they are cached with empty
+   ref and alt and shared by every variant at a position. first() results
+   are cached on their own, with alt 'first', so only the row is kept.
+   variant (the strategy and its settings) is part of the key: which rows
+   come back, and in what order, is up to the strategy.
+"""
+class CachedLookup(LookupStrategy):
+
+    def __init__(self, index, cache, stage, variant=''):
+        self.index = index
+        self.cache = cache
+        self.stage = stage
+        self.variant = variant
+
+    def overlaps(self, chrom, pos, end=None):
+        if (end is not None):
+            return self.index.overlaps(chrom, pos, end)
+        return self.overlaps_many([(chrom, pos)])[0]
+
+    def overlaps_many(self, lookups):
+        return self.cache.resolve(self.stage,
+            [(chrom, pos, '', '') for chrom, pos in lookups],
+            lambda missing: self.index.overlaps_many(
+                [lookups[i] for i in missing]), self.variant)
+
+    def first(self, chrom, pos, end=None):
+        if (end is not None):
+            return self.index.first(chrom, pos, end)
+        return self.first_many([(chrom, pos)])[0]
+
+    def first_many(self, lookups):
+        return self.cache.resolve(self.stage,
+            [(chrom, pos, '', 'first') for chrom, pos in lookups],
+            lambda missing: self.index.first_many(
+                [lookups[i] for i in missing]), self.variant)
+
+    def close(self):
+        self.index.close()
+
+### EOF
\ No newline at end of file
@@ -9,6 +9,7 @@ import time
 import json
 import boto3
 import driver
+from result_cache import ResultCache
 import shutil
 import logging
 from configparser import ConfigParser
@@ -39,6 +40,9 @@ table = dynamodb.Table(config['aws']['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
 #Bucket
 s3_outputs_bucket = config['aws']['AWS_S3_RESULTS_BUCKET']
 
+#Results, plain or BGZF-compressed (COMPRESS_RESULT)
+RESULT_EXTENSIONS = (".annot.vcf", ".annot.vcf.gz")
+
 ################################################################################
 # TIMER CLASS
 ################################################################################
@@ -173,7 +177,26 @@ def notify_glacier_of_free_job_completion(job_id):
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         with Timer():
-            driver.run(sys.argv[1], 'vcf')
+            cache = None
+            if config.get('ann', 'RESULT_CACHE'):
+                cache = ResultCache(config.get('ann', 'RESULT_CACHE'),
+                    config.get('ann', 'REFERENCE_VERSION'),
+                    disk_size=config.getint('ann', 'RESULT_CACHE_SIZE'))
+            driver.run(sys.argv[1], 'vcf',
+                dbsnp_batch_size=config.getint('ann', 'DBSNP_BATCH_SIZE'),
+                fused=config.getboolean('ann', 'FUSED_PIPELINE'),
+                strategy=config.get('ann', 'LOOKUP_STRATEGY') or None,
+                snapshot_dir=config.get('ann', 'SNAPSHOT_DIR') or None,
+                workers=int(config.get('ann', 'WORKERS') or os.cpu_count()),
+                cache=cache,
+                concurrency=driver.parseConcurrency(
+                    config.get('ann', 'QUERY_CONCURRENCY')),
+                dbsnp_filter=config.get('ann', 'DBSNP_FILTER') or None,
+                compress=config.getboolean('ann', 'COMPRESS_RESULT'),
+                max_connections=int(
+                    config.get('ann', 'MAX_CONNECTIONS') or 0) or None)
+            if cache is not None:
+                cache.close()
             #Load inputs
             filename = sys.argv[1]
             filename_dir = filename[:filename.rfind('/')]
@@ -181,7 +204,7 @@ if __name__ == "__main__":
             files_to_upload = []
             for file in os.listdir(filename_dir):
                 file_path = os.path.join(filename_dir, file).strip()
-                if file.endswith(".annot.vcf") or file.endswith(".count.log"):
+                if file.endswith(RESULT_EXTENSIONS) or file.endswith(".count.log"):
                     files_to_upload.append(file_path)
             #Get S3 key
             job_id = filename.split('/')[2]
@@ -191,7 +214,7 @@ if __name__ == "__main__":
             for file in files_to_upload:
                 key = f"{s3_key_prefix}/{file.split('../jobs/')[1]}"
                 upload_file_to_s3_bucket(s3_outputs_bucket, file, key)
-                if file.endswith(".annot.vcf"):
+                if file.endswith(RESULT_EXTENSIONS):
                     result_key = f"{response['Item'].get('s3_key').split('~')[0]}/{file.split('/')[-1]}"
                 elif file.endswith(".count.log"):
                     log_key = f"{response['Item'].get('s3_key').split('~')[0]}/{file.split('/')[-1]}"
@@ -223,6 +246,6 @@ if __name__ == "__main__":
             except Exception as e:
                 logger.error(f"Failed to notify glacier queue of job completion: {e}")
     else:
-        logger.error("Usage: <HW_ID>_run.py <path>/<input_filename>.vcf")
+        logger.error("Usage: <HW_ID>_run.py <path>/<input_filename>.vcf[.gz]")
 
 ### EOF
@@ -0,0 +1,380 @@
+# snapshot.py
+#
+# Exports the reference tables of the annotators into per-chromosome
+# NumPy arrays, and answers lookups against them
+#
+# Usage: python snapshot.py <directory> [table ...]
+#        python snapshot.py --max-age <seconds> <directory>
+#
+# For every table and chromosome the snapshot holds, in start order:
+#   <n>.starts.npy, <n>.ends.npy - interval coordinates
+#   <n>.maxends.npy - largest end of every subtree of the implicit interval
+#       tree over the rows (interval_index.tree_maxends)
+#   <n>.ordinals.npy - position of each row in table order
+#   <n>.offsets.npy, <n>.rows.npy - the pickled rows
+# manifest.json maps table and chromosome to those files; its entries
+# record the LAYOUT of the arrays, snapshots of an older one are rebuilt.
+#
+# The arrays are memory-mapped read-only, so every job on a host shares
+# one copy through the page cache. Each build writes a new version
+# directory and then swaps the manifest; files a running job has mapped
+# are never rewritten, and old versions are removed a grace period after
+# they were superseded (see prune).
+#
+##
+
+import os
+import sys
+import json
+import time
+import fcntl
+import pickle
+import shutil
+import numpy as np
+
+import utils as u
+from interval_index import LookupStrategy, SHARDS, tree_maxends, \
+    row_order, order_clause
+
+MANIFEST = 'manifest.json'
+# Layout of the arrays; maxends used to be the running maximum of the ends
+LAYOUT = 'tree'
+
+# Tables exported by default, with the columns their annotators look up
+TABLES = [
+    dict(table='cytoBand'),
+    dict(table='gadAll', chrom_col='chromosome'),
+    dict(table='gwasCatalog', start_col='chromEnd', end_col='chromEnd'),
+    dict(table='targetScanS'),
+    dict(table='hugo'),
+    dict(table='dgv_Cnv'),
+    dict(table='abParts_IG_T_CelReceptors'),
+    dict(table='mcCarroll_Cnv'),
+    dict(table='conrad_Cnv'),
+    dict(table='genomicSuperDups'),
+    dict(table='tfbsConsSites', sharded=True,
+        columns='chrom, chromStart, chromEnd, name'),
+    dict(table='refGene', start_col='txStart', end_col='txEnd'),
+    dict(table='cpgIslandExt', columns='chrom, chromStart, chromEnd, name'),
+]
+
+# Seconds an unused version directory is kept for jobs still reading it
+GRACE_PERIOD = 86400
+# Marks a version directory the manifest no longer refers to; its mtime is
+# the time the version was superseded
+SUPERSEDED = '.superseded'
+
+
+def table_spec(chrom_col='chrom', start_col='chromStart',
+    end_col='chromEnd', columns='*'):
+    return dict(chrom_col=chrom_col, start_col=start_col, end_col=end_col,
+        columns=columns)
+
+
+"""Writes the arrays of one chromosome; rows are in table order
+"""
+def write_chrom(directory, name, rows, start_ind, end_ind):
+    starts = np.array([int(row[start_ind]) for row in rows], dtype=np.int64)
+    ends = np.array([int(row[end_ind]) for row in rows], dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+
+    blobs = [pickle.dumps(tuple(rows[i])) for i in order]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in blobs])
+
+    maxends = tree_maxends([int(end) for end in ends[order]])[0]
+    arrays = dict(starts=starts[order], ends=ends[order],
+        maxends=np.array(maxends, dtype=np.int64),
+        ordinals=order.astype(np.int64), offsets=offsets,
+        rows=np.frombuffer(b''.join(blobs), dtype=np.uint8))
+    for key, array in arrays.items():
+        np.save(os.path.join(directory, name + '.' + key + '.npy'), array)
+
+
+"""Exports one table into directory/<version>/<table>/ and returns its
+   manifest entry
+   sharded tables are split into <table>1, ... <table>Y and keyed by the
+   shard suffix, as interval_index.ShardPointQuery does
+"""
+def export_table(cursor, directory, version, table, sharded=False,
+    **kwargs):
+    spec = table_spec(**kwargs)
+    spec['path'] = os.path.join(version, table)
+    table_dir = os.path.join(directory, spec['path'])
+    os.makedirs(table_dir, exist_ok=True)
+
+    # Rows are exported in table order, which the lookups report them in
+    if sharded:
+        sources = [(shard, 'select ' + spec['columns'] + ' from ' + table +
+            shard + order_clause(row_order(cursor, table + shard)) + ';')
+            for shard in SHARDS]
+    else:
+        order = order_clause(row_order(cursor, table))
+        cursor.execute('select distinct ' + spec['chrom_col'] + ' from ' +
+            table + ';')
+        sources = [(str(row[0]), 'select ' + spec['columns'] + ' from ' +
+            table + ' where ' + spec['chrom_col'] + '="' +
+            str(row[0]).replace('"', '') + '"' + order + ';')
+            for row in cursor.fetchall()]
+
+    chroms = {}
+    for chrom, sql in sources:
+        cursor.execute(sql)
+        names = [d[0] for d in cursor.description]
+        name = str(len(chroms))
+        write_chrom(table_dir, name, cursor.fetchall(),
+            names.index(spec['start_col']), names.index(spec['end_col']))
+        chroms[chrom] = name
+
+    spec['chroms'] = chroms
+    spec['layout'] = LAYOUT
+    return spec
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fh:
+        return json.load(fh)
+
+
+"""Tables directory holds a snapshot of, in the current LAYOUT
+"""
+def published_tables(directory):
+    return set([table for table, entry in read_manifest(directory).items()
+        if (entry.get('layout') == LAYOUT)])
+
+
+"""Exports tables (default: TABLES) into a new version of directory
+   The manifest is swapped last, so readers never see a partial table
+"""
+def build(directory, tables=None):
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    version = 'v' + time.strftime('%Y%m%d%H%M%S') + '.' + str(os.getpid())
+
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    for kwargs in TABLES:
+        if (tables is None or kwargs['table'] in tables):
+            print(f"Exporting {kwargs['table']} . . .")
+            manifest[kwargs['table']] = export_table(cursor, directory,
+                version, **kwargs)
+    conn.close()
+
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(path + '.tmp', path)
+    prune(directory)
+
+
+"""Removes the version directories the manifest no longer refers to, grace
+   seconds after they were superseded
+   Jobs that opened an index before the swap map its files lazily, one
+   chromosome at a time, so the grace period counts from the swap and not
+   from the build: a version found unused for the first time is marked
+   SUPERSEDED and kept.
+"""
+def prune(directory, grace=GRACE_PERIOD):
+    used = set([entry['path'].split(os.sep)[0]
+        for entry in read_manifest(directory).values()])
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if (not name.startswith('v') or not os.path.isdir(path) or
+            name in used):
+            continue
+
+        marker = os.path.join(path, SUPERSEDED)
+        if not os.path.exists(marker):
+            open(marker, 'w').close()
+        elif (time.time() - os.path.getmtime(marker) > grace):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+"""True if directory holds no snapshot, one older than max_age seconds or
+   one of another LAYOUT
+"""
+def is_stale(directory, max_age):
+    path = os.path.join(directory, MANIFEST)
+    return (not os.path.exists(path) or
+        time.time() - os.path.getmtime(path) > max_age or
+        any([entry.get('layout') != LAYOUT
+            for entry in read_manifest(directory).values()]))
+
+
+"""Builds the snapshot of the host unless a fresh one exists
+   Concurrent callers wait for the one building it
+"""
+def publish(directory, max_age):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if is_stale(directory, max_age):
+            build(directory)
+
+
+"""Indices of the rows overlapping each [lo, hi] of los and his, in start
+   order
+   interval_index.tree_overlaps over the arrays of a chromosome, run one
+   level of the tree at a time for all the ranges at once: the frontier
+   holds the (range, node) pairs still to visit, and the subtrees of at
+   most 15 rows at the bottom are scanned whole.
+"""
+def tree_overlaps_many(starts, ends, maxends, los, his):
+    n = len(starts)
+    if (n == 0):
+        return [np.zeros(0, dtype=np.int64) for lo in los]
+
+    k = n.bit_length() - 1
+    ranges = np.arange(len(los), dtype=np.int64)
+    nodes = np.full(len(los), (1 << k) - 1, dtype=np.int64)
+    found_ranges = []
+    found_rows = []
+    while (k > 3 and len(ranges) > 0):
+        half = 1 << (k - 1)
+        lo = los[ranges]
+        left = nodes - half
+        # Nodes past the last row have no interval but a left subtree
+        to_left = (left >= n) | (maxends[np.minimum(left, n - 1)] >= lo)
+        node = np.minimum(nodes, n - 1)
+        here = (nodes < n) & (starts[node] <= his[ranges])
+        hit = here & (ends[node] >= lo)
+        found_ranges.append(ranges[hit])
+        found_rows.append(nodes[hit])
+        ranges = np.concatenate([ranges[to_left], ranges[here]])
+        nodes = np.concatenate([left[to_left], nodes[here] + half])
+        k = k - 1
+
+    if (len(ranges) > 0):
+        first = (nodes >> k) << k
+        rows = first[:, None] + np.arange((1 << (k + 1)) - 1)
+        inside = rows < n
+        rows = np.minimum(rows, n - 1)
+        hit = inside & (starts[rows] <= his[ranges][:, None]) & \
+            (ends[rows] >= los[ranges][:, None])
+        found_ranges.append(np.broadcast_to(ranges[:, None], rows.shape)[hit])
+        found_rows.append(rows[hit])
+
+    ranges = np.concatenate(found_ranges)
+    rows = np.concatenate(found_rows)
+    order = np.lexsort((rows, ranges))
+    ranges = ranges[order]
+    rows = rows[order]
+    bounds = np.searchsorted(ranges, np.arange(len(los) + 1))
+    return [rows[bounds[i]:bounds[i + 1]] for i in range(0, len(los))]
+
+
+"""Lookups against one table of a snapshot
+
+The arrays of a chromosome are memory-mapped on its first lookup. A chunk
+of positions (or [pos, end] ranges) is resolved by walking the implicit
+interval tree stored in them (see tree_overlaps_many), so long intervals
+do not widen the rows every lookup looks at. The hits are returned in
+table order, as the query would return them.
+"""
+class SnapshotIndex(LookupStrategy):
+
+    def __init__(self, directory, table, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', columns='*'):
+        if (directory is None):
+            raise ValueError(f"No snapshot directory given for {table}")
+        manifest = read_manifest(directory)
+        if (table not in manifest):
+            raise ValueError(f"No snapshot of {table} in {directory}")
+
+        entry = manifest[table]
+        if (entry.get('layout') != LAYOUT):
+            raise ValueError(f"Snapshot of {table} in {directory} has an " +
+                "old layout, rebuild it")
+        spec = table_spec(chrom_col=chrom_col, start_col=start_col,
+            end_col=end_col, columns=columns)
+        for key, value in spec.items():
+            if (entry[key] != value):
+                raise ValueError(f"Snapshot of {table} was built with " +
+                    f"{key}={entry[key]}, not {value}")
+
+        self.table_dir = os.path.join(directory, entry['path'])
+        self.names = entry['chroms']
+        self.chroms = {}
+
+    def chrom(self, chrom):
+        arrays = self.chroms.get(chrom)
+        if (arrays is None):
+            name = self.names.get(str(chrom))
+            arrays = {}
+            if (name is not None):
+                for key in ['starts', 'ends', 'maxends', 'ordinals',
+                    'offsets', 'rows']:
+                    # A plain view of the mapping, without the per-index
+                    # overhead of np.memmap
+                    arrays[key] = np.asarray(np.load(os.path.join(
+                        self.table_dir, name + '.' + key + '.npy'),
+                        mmap_mode='r'))
+            self.chroms[chrom] = arrays
+        return arrays
+
+    def _row(self, arrays, i):
+        offsets = arrays['offsets']
+        return pickle.loads(
+            arrays['rows'][offsets[i]:offsets[i + 1]].tobytes())
+
+    """Indices of the rows overlapping each [pos, end], in table order
+    """
+    def _resolve(self, arrays, positions, range_ends):
+        if (len(arrays) == 0 or len(arrays['starts']) == 0):
+            return [[] for p in positions]
+
+        ordinals = arrays['ordinals']
+        found = []
+        for hits in tree_overlaps_many(arrays['starts'], arrays['ends'],
+            arrays['maxends'], positions, range_ends):
+            found.append(hits[np.argsort(ordinals[hits], kind='stable')])
+        return found
+
+    """lookups are (chrom, pos) or (chrom, pos, end) tuples
+    """
+    def _many(self, lookups, first):
+        results = [None] * len(lookups)
+        by_chrom = {}
+        for i, lookup in enumerate(lookups):
+            by_chrom.setdefault(lookup[0], []).append(i)
+
+        for chrom, slots in by_chrom.items():
+            arrays = self.chrom(chrom)
+            positions = np.array([int(lookups[i][1]) for i in slots],
+                dtype=np.int64)
+            range_ends = np.array([int(lookups[i][-1]) for i in slots],
+                dtype=np.int64)
+            for i, hits in zip(slots,
+                self._resolve(arrays, positions, range_ends)):
+                if first:
+                    results[i] = self._row(arrays, hits[0]) \
+                        if (len(hits) > 0) else None
+                else:
+                    results[i] = [self._row(arrays, j) for j in hits]
+
+        return results
+
+    def overlaps(self, chrom, pos, end=None):
+        lookup = (chrom, pos) if (end is None) else (chrom, pos, end)
+        return self._many([lookup], False)[0]
+
+    def overlaps_many(self, lookups):
+        return self._many(lookups, False)
+
+    def first_many(self, lookups):
+        return self._many(lookups, True)
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 3 and sys.argv[1] == '--max-age'):
+        publish(sys.argv[3], int(sys.argv[2]))
+    elif (len(sys.argv) > 1):
+        build(sys.argv[1], sys.argv[2:] or None)
+    else:
+        print("Usage: python snapshot.py <directory> [table ...]\n" +
+            "       python snapshot.py --max-age <seconds> <directory>")
+
+### EOF
\ No newline at end of file
@@ -0,0 +1,83 @@
+# test_dbsnp_filter.py
+#
+# The dbSNP Bloom filter in front of the batched dbSNP queries, against an
+# SQLite stand-in of the dbSNP table
+#
+# Usage: python -m unittest test_dbsnp_filter
+#
+##
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import query as q
+import dbsnp_filter
+from dbsnp_filter import DbSnpFilter
+from annotate import queryDbSnpScreened
+
+# (CHR, POS, IDX, RSID, REF, ALT, QUAL, GMAF, INFO)
+ROWS = [('1', pos, i, 'rs' + str(i), 'A', 'G', 50, '.', 'SNV')
+    for i, pos in enumerate(range(1000, 2000, 10))]
+
+
+class DbSnpFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'dbsnp.db')
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('create table dbSNP (CHR, POS integer, IDX, ' +
+            'RSID, REF, ALT, QUAL, GMAF, INFO);')
+        self.conn.executemany('insert into dbSNP values ' +
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?);', ROWS)
+        self.conn.commit()
+
+        self.path = os.path.join(self.directory, 'dbsnp.bloom')
+        with mock.patch.object(dbsnp_filter.u, 'db_connect',
+            lambda: sqlite3.connect(path)):
+            dbsnp_filter.build(self.path, fp_rate=0.000001)
+        self.screen = DbSnpFilter(self.path)
+        q.reset_counts()
+
+    def tearDown(self):
+        self.screen.close()
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def query(self, variants):
+        return queryDbSnpScreened(self.conn.cursor(), variants,
+            dbsnp_filter=self.screen)
+
+    def test_screened_chromosome_is_not_queried(self):
+        variants = [('1', '1010', 'A', 'T'), ('2', '1010', 'A', 'T'),
+            ('2', '1500', 'C', 'G'), ('1', '1015', 'A', 'T')]
+        found, screened, positions, queries = self.query(variants)
+
+        self.assertEqual([len(rows) for rows in found], [1, 0, 0, 0])
+        self.assertEqual(found[0][0][3], 'rs1')
+        self.assertEqual((screened, positions, queries), (3, 3, 1))
+        # Chromosome 1 only
+        self.assertEqual(q.counts()['executed'], 1)
+
+    def test_fully_screened_batch_runs_no_query(self):
+        variants = [('2', '1010', 'A', 'T'), ('X', '1500', 'C', 'G'),
+            ('X', '1500', 'G', 'C')]
+        found, screened, positions, queries = self.query(variants)
+
+        self.assertEqual(found, [[], [], []])
+        self.assertEqual((screened, positions, queries), (3, 2, 2))
+        self.assertEqual(q.counts()['executed'], 0)
+
+    def test_every_dbsnp_position_passes(self):
+        for row in ROWS:
+            self.assertTrue(self.screen.might_contain(row[0], row[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -0,0 +1,82 @@
+# transcripts.py
+#
+# Pre-parsed refGene transcript models for the gene structure annotators
+#
+# A refGene row carries its exons as comma-separated blobs; a Transcript
+# holds them as integer lists, parsed once per process, and finds the
+# exons covering a position by bisection.
+#
+##
+
+from bisect import bisect_right
+
+# Transcripts kept per process; refGene holds far fewer
+MAX_TRANSCRIPTS = 200000
+
+_transcripts = {}
+
+
+class Transcript(object):
+
+    __slots__ = ('txStart', 'txEnd', 'cdsStart', 'cdsEnd', 'exonCount',
+        'strand', 'exonStarts', 'exonEnds', 'maxEnds', 'ordered')
+
+    def __init__(self, row):
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.strand = str(row[3])
+        self.exonStarts = self._parse(row[9])
+        self.exonEnds = self._parse(row[10])
+        self.ordered = (self.exonStarts == sorted(self.exonStarts))
+
+        # Running maximum of the exon ends, to stop the backward scan
+        self.maxEnds = []
+        last = None
+        for end in self.exonEnds:
+            last = end if (last is None or end > last) else last
+            self.maxEnds.append(last)
+
+    def _parse(self, blob):
+        if isinstance(blob, bytes):
+            blob = blob.decode('utf-8')
+        return [int(x) for x in str(blob).split(',')[0:self.exonCount]]
+
+    """Numbers of the exons covering pos, counted from the 5' end
+       (exon 1 of a '-' strand transcript is its last in the table)
+       In increasing position order, as the scan over all exons found them
+    """
+    def exon_numbers(self, pos):
+        if not self.ordered:
+            # Malformed row, scan every exon
+            covering = [e for e in range(0, len(self.exonStarts))
+                if (self.exonStarts[e] <= pos <= self.exonEnds[e])]
+        else:
+            covering = []
+            e = bisect_right(self.exonStarts, pos) - 1
+            while (e >= 0 and self.maxEnds[e] >= pos):
+                if (pos <= self.exonEnds[e]):
+                    covering.append(e)
+                e = e - 1
+            covering.reverse()
+
+        if (self.strand == '-'):
+            return [self.exonCount - e for e in covering]
+        return [e + 1 for e in covering]
+
+
+"""Transcript model of a refGene row, parsed on first use
+"""
+def get_transcript(row):
+    key = tuple(row[1:11])
+    transcript = _transcripts.get(key)
+    if (transcript is None):
+        if (len(_transcripts) >= MAX_TRANSCRIPTS):
+            _transcripts.clear()
+        transcript = Transcript(row)
+        _transcripts[key] = transcript
+    return transcript
+
+### EOF
\ No newline at end of file
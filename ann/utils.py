@@ -13,25 +13,51 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+RDS_SECRET_ID = 'rds/anntools_database'
+# Seconds the RDS secret is reused before it is fetched again
+RDS_SECRET_TTL = 300
+
+_secrets = {}
+_secrets_lock = threading.Lock()
+
+"""Get the reference database credentials from AWS Secrets Manager
+   The secret is cached for ttl seconds
 """
-def db_connect():
+def get_db_secret(secret_id=RDS_SECRET_ID, ttl=RDS_SECRET_TTL):
+    with _secrets_lock:
+        cached = _secrets.get(secret_id)
+    if ((cached is not None) and (time.time() - cached[0] < ttl)):
+        return cached[1]
+
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
         ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
     # Get RDS secret from AWS Secrets Manager
     asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
     try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
+        asm_response = asm.get_secret_value(SecretId=secret_id)
         rds_secret = json.loads(asm_response['SecretString'])
     except ClientError as e:
         print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
         raise e
 
+    with _secrets_lock:
+        _secrets[secret_id] = (time.time(), rds_secret)
+    return rds_secret
+
+
+def clear_db_secret():
+    with _secrets_lock:
+        _secrets.clear()
+
+
+def _connect(rds_secret):
     # Extract database connection parameters
     rds_host = rds_secret['host']
     mysql_port = rds_secret['port']
@@ -48,6 +74,86 @@ def db_connect():
         db=database_name)
 
 
+"""Get connection to reference database
+"""
+def db_connect():
+    try:
+        return _connect(get_db_secret())
+    except pymysql.err.OperationalError:
+        # The secret may have been rotated since it was cached
+        clear_db_secret()
+        return _connect(get_db_secret())
+
+
+"""Small pool of live reference database connections
+   connect opens a new connection (default: db_connect), so any DB-API
+   connection, e.g. sqlite3, can stand in for MySQL. Idle connections are
+   checked before they are handed out again and replaced when the check
+   fails; at most size of them are kept.
+"""
+class ConnectionPool(object):
+
+    def __init__(self, connect=None, size=4):
+        self.connect = connect
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _open(self):
+        if (self.connect is None):
+            return db_connect()
+        return self.connect()
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    """Health check; pymysql connections reconnect in place if they can
+    """
+    def _alive(self, conn):
+        try:
+            if hasattr(conn, 'ping'):
+                conn.ping(reconnect=True)
+            else:
+                conn.cursor().execute('select 1')
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                conn = self.idle.pop() if (len(self.idle) > 0) else None
+            if (conn is None):
+                return self._open()
+            if self._alive(conn):
+                return conn
+            self._close(conn)
+
+    def release(self, conn):
+        try:
+            # End the read transaction so the next user sees fresh data
+            conn.rollback()
+        except Exception:
+            self._close(conn)
+            return
+
+        with self.lock:
+            if (len(self.idle) < self.size):
+                self.idle.append(conn)
+                return
+        self._close(conn)
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            self._close(conn)
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):
@@ -98,24 +204,40 @@ def isBetween(testStart, refStart, refEnd):
         return False
 
 
-"""Helper method to deduplicate the list
+"""Helper method to deduplicate the list, keeping the first occurrences
 """
 def dedup(mylist):
-    outlist = []
-    for element in mylist:
-        if element not in outlist:
-            outlist.append(element)
-    return outlist
+    try:
+        return list(dict.fromkeys(mylist))
+    except TypeError:
+        # Unhashable elements
+        outlist = []
+        for element in mylist:
+            if element not in outlist:
+                outlist.append(element)
+        return outlist
 
 
 """Helper method to parse fields
 """
 def parse_field(text, key, sep1, sep2):
-    fields = text.strip().split(sep1)
-    for f in fields:
-        pairs = f.split(sep2)
-        if (str(pairs[0]).find(str(key)) > -1):
-            return str(pairs[1])
+    return find_field(parse_fields(text, sep1, sep2), key)
+
+
+"""Splits text into the pairs parse_field looks keys up in, so a record
+   can be split once for several keys
+"""
+def parse_fields(text, sep1, sep2):
+    return [f.split(sep2) for f in text.strip().split(sep1)]
+
+
+"""Value of the first pair of parse_fields whose name contains key
+"""
+def find_field(pairs, key):
+    key = str(key)
+    for pair in pairs:
+        if (key in str(pair[0])):
+            return str(pair[1])
     return '.'
 
 ### EOF
\ No newline at end of file
@@ -243,12 +243,17 @@ def annotation_details(id):
               key = annotation['s3_key'].split('~')[0]+'/'+result_file_name
               print("key:", key)
               app.logger.info(f"key: {key}")
+              params = {
+                  'Bucket': app.config['AWS_S3_RESULTS_BUCKET'],
+                  'Key': key
+              }
+              #BGZF results (.annot.vcf.gz) are saved as they are, not inflated by the browser
+              if result_file_name.endswith('.gz'):
+                  params['ResponseContentType'] = 'application/gzip'
+                  params['ResponseContentDisposition'] = f'attachment; filename="{result_file_name}"'
               presigned_url = s3.generate_presigned_url(
                   ClientMethod='get_object', 
-                  Params={
-                      'Bucket': app.config['AWS_S3_RESULTS_BUCKET'],
-                      'Key': key
-                  }, 
+                  Params=params, 
                   ExpiresIn=3600)
               annotation['result_file_url'] = presigned_url
             except ClientError as e: